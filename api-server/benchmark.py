@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the MultiDesk Address Book API Server
+
+Every benchmark runs against a throwaway SQLite database and a local uvicorn
+instance, so the configured DATABASE_URL is never touched.
+
+Usage: python benchmark.py <benchmark> [options]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+
+# Point the server at a scratch database before main is imported
+_tmpdir = tempfile.TemporaryDirectory(prefix="multidesk-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir.name}/bench.db"
+
+import uvicorn
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import event, insert, select
+
+import main
+import migrate
+
+
+class Server:
+    """Runs the API app on a free local port in a background thread"""
+
+    def __init__(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        config = uvicorn.Config(main.app, host="127.0.0.1", port=self.port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+    def request(self, method: str, path: str, token: str = None, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(f"http://127.0.0.1:{self.port}{path}", data=data, method=method)
+        req.add_header("Content-Type", "application/json")
+        if token:
+            req.add_header("Authorization", f"Bearer {token}")
+        with urllib.request.urlopen(req) as resp:
+            return json.loads(resp.read())
+
+
+def create_user(username: str, role: str = "user") -> tuple:
+    """Create a user and return (id, token)"""
+    db = main.SessionLocal()
+    try:
+        user = main.User(username=username, password_hash=main.get_password_hash(username), role=role)
+        db.add(user)
+        db.commit()
+        return user.id, main.create_access_token(data={"sub": username})
+    finally:
+        db.close()
+
+
+def seed_clients(start: int, end: int, owner_id: int) -> list:
+    """Bulk insert client IDs numbered [start, end), tagged "bench", and return their ids"""
+    rows = [{
+        "client_id": f"{100000000 + i}",
+        "alias": f"host-{i}",
+        "notes": "",
+        "created_by": owner_id,
+    } for i in range(start, end)]
+    with main.engine.begin() as conn:
+        ids = conn.execute(insert(main.ClientID).returning(main.ClientID.id), rows).scalars().all()
+        conn.execute(insert(main.PeerTag), [{"client_id": id, "tag": "bench"} for id in ids])
+    return ids
+
+
+def seed_users(start: int, end: int, client_ids: list):
+    """Bulk insert users numbered [start, end), each granted read on client_ids"""
+    with main.engine.begin() as conn:
+        user_ids = conn.execute(insert(main.User).returning(main.User.id), [
+            {"username": f"seed-{i}", "password_hash": "!", "role": "user"} for i in range(start, end)
+        ]).scalars().all()
+    grant_read(user_ids, client_ids)
+
+
+def grant_read(user_ids: list, client_ids: list):
+    """Grant every user read on every client, bypassing the API"""
+    with main.engine.begin() as conn:
+        conn.execute(insert(main.UserClientPermission), [
+            {"user_id": user_id, "client_id": client_id, "permission_type": "read"}
+            for user_id in user_ids for client_id in client_ids
+        ])
+        for stmt in main.effective_permission_statements(user_ids, client_ids):
+            conn.execute(stmt)
+
+
+def timed(fn, repeat: int) -> list:
+    """Call fn repeat times and return per-call latencies in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def bench_pagination(args):
+    """Page latency of POST /api/ab/peers as the table grows"""
+    admin_id, token = create_user("bench-admin", "admin")
+    print(f"{'rows':>8} {'first page p50':>15} {'last page p50':>15} {'last cursor p50':>16}")
+    seeded = 0
+    with Server() as server:
+        for size in args.sizes:
+            seed_clients(seeded, size, admin_id)
+            seeded = size
+            last = (size + args.page_size - 1) // args.page_size
+            first = timed(lambda: server.request(
+                "POST", f"/api/ab/peers?current=1&pageSize={args.page_size}", token), args.repeat)
+            deep = timed(lambda: server.request(
+                "POST", f"/api/ab/peers?current={last}&pageSize={args.page_size}", token), args.repeat)
+            # Cursor pointing at the row just before the last page
+            db = main.SessionLocal()
+            try:
+                before = db.query(main.ClientID).order_by(main.ClientID.client_id, main.ClientID.id) \
+                    .offset((last - 1) * args.page_size - 1).first()
+            finally:
+                db.close()
+            cursor = main.encode_cursor(before.client_id, before.id)
+            keyset = timed(lambda: server.request(
+                "POST", f"/api/ab/peers?cursor={cursor}&pageSize={args.page_size}", token), args.repeat)
+            print(f"{size:>8} {statistics.median(first):>12.2f} ms {statistics.median(deep):>12.2f} ms "
+                  f"{statistics.median(keyset):>13.2f} ms")
+
+
+def bench_login_storm(args):
+    """/api/ab/peers latency while other clients hammer /api/login"""
+    admin_id, token = create_user("bench-admin", "admin")
+    seed_clients(0, args.sizes[0], admin_id)
+    for i in range(args.concurrency):
+        create_user(f"storm-{i}")
+
+    with Server() as server:
+        def read_page():
+            server.request("POST", f"/api/ab/peers?current=1&pageSize={args.page_size}", token)
+
+        idle = timed(read_page, args.repeat)
+
+        stop = threading.Event()
+        logins = [0, 0]  # ok, rejected
+
+        def storm(i):
+            body = {"username": f"storm-{i}", "password": f"storm-{i}"}
+            while not stop.is_set():
+                try:
+                    server.request("POST", "/api/login", body=body)
+                    logins[0] += 1
+                except urllib.error.HTTPError:
+                    logins[1] += 1
+
+        threads = [threading.Thread(target=storm, args=(i,)) for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        t0 = time.perf_counter()
+        try:
+            busy = timed(read_page, args.repeat)
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        elapsed = time.perf_counter() - t0
+
+    print(f"{'':>14} {'p50':>10} {'p99':>10}")
+    print(f"{'idle':>14} {percentile(idle, 50):>7.2f} ms {percentile(idle, 99):>7.2f} ms")
+    print(f"{'login storm':>14} {percentile(busy, 50):>7.2f} ms {percentile(busy, 99):>7.2f} ms")
+    print(f"{args.concurrency} login clients: {logins[0] / elapsed:.1f} logins/s, {logins[1]} rejected")
+
+
+class BlockingSession:
+    """A sync Session behind the AsyncSession methods the read endpoints await
+
+    Every query runs to completion on the event loop, as the handlers did
+    before the async engine.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self.info = db.info
+
+    async def execute(self, *args, **kwargs):
+        return self._db.execute(*args, **kwargs)
+
+    async def close(self):
+        self._db.close()
+
+
+def sync_db():
+    """The request session of the sync implementation: a plain def dependency,
+    so FastAPI opens it on its threadpool, on the sync engine's QueuePool"""
+    db = main.SessionLocal()
+    try:
+        yield BlockingSession(db)
+    finally:
+        db.close()
+
+
+def bench_concurrency(args):
+    """Throughput and tail latency of address book reads under concurrent clients
+
+    With --sync the reads (and token lookups the auth cache misses) go through
+    the sync session path the server used before the async engine, for comparison.
+    """
+    admin_id, token = create_user("bench-admin", "admin")
+    seed_clients(0, args.sizes[0], admin_id)
+    if args.sync:
+        main.app.dependency_overrides[main.get_read_db] = sync_db
+        main.app.dependency_overrides[main.get_db] = sync_db
+
+    with Server() as server:
+        def client(samples):
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                try:
+                    server.request("POST", f"/api/ab/peers?current=1&pageSize={args.page_size}", token)
+                except urllib.error.HTTPError:
+                    failures.append(1)
+                samples.append((time.perf_counter() - t0) * 1000)
+
+        for concurrency in sorted({1, args.concurrency // 2 or 1, args.concurrency}):
+            failures = []
+            results = [[] for _ in range(concurrency)]
+            threads = [threading.Thread(target=client, args=(r,)) for r in results]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - t0
+            samples = [x for r in results for x in r]
+            print(f"{concurrency:>3} clients: {len(samples) / elapsed:>7.1f} req/s, "
+                  f"p50 {percentile(samples, 50):.2f} ms, p99 {percentile(samples, 99):.2f} ms, "
+                  f"{len(failures)} failed")
+
+
+def stock_json_response(content, response=None):
+    """What FastAPI does with a returned dict: jsonable_encoder, then the standard JSONResponse"""
+    return JSONResponse(jsonable_encoder(content), headers=dict(response.headers) if response is not None else None)
+
+
+def bench_large_page(args):
+    """Latency of the whole address book as one /api/ab/peers page, and of /api/admin/clients
+
+    With --stock-json the endpoints serialize through FastAPI's default path
+    instead of orjson, for comparison.
+    """
+    admin_id, token = create_user("bench-admin", "admin")
+    if args.stock_json:
+        main.json_response = stock_json_response
+    print(f"{'rows':>8} {'one page p50':>14} {'one page p99':>14} {'admin clients p50':>18}")
+    seeded = 0
+    with Server() as server:
+        for size in args.sizes:
+            seed_clients(seeded, size, admin_id)
+            seeded = size
+            page = timed(lambda: server.request("POST", f"/api/ab/peers?current=1&pageSize={size}", token), args.repeat)
+            clients = timed(lambda: server.request("GET", "/api/admin/clients", token), args.repeat)
+            print(f"{size:>8} {percentile(page, 50):>11.2f} ms {percentile(page, 99):>11.2f} ms "
+                  f"{percentile(clients, 50):>15.2f} ms")
+
+
+# (list, full entity select, the column-projected select its endpoint now runs)
+PROJECTION_CHECKS = [
+    ("users", select(main.User),
+     select(main.User.id, main.User.username, main.User.email, main.User.role, main.User.created_at)),
+    ("clients", select(main.ClientID),
+     select(*main.PEER_COLUMNS, main.ClientID.created_by, main.ClientID.created_at)),
+]
+
+
+def bench_projection(args):
+    """Time and peak memory of loading whole tables as ORM entities versus column rows"""
+    admin_id, _ = create_user("bench-admin", "admin")
+    with main.engine.begin() as conn:
+        conn.execute(insert(main.User), [
+            {"username": f"seed-{i}", "password_hash": "!", "email": f"seed-{i}@example.com", "role": "user"}
+            for i in range(args.sizes[-1])
+        ])
+    seed_clients(0, args.sizes[-1], admin_id)
+
+    async def load(query, entities):
+        async with main.AsyncSessionLocal() as db:
+            result = await db.execute(query)
+            return result.scalars().all() if entities else result.all()
+
+    def measure(query, entities):
+        tracemalloc.start()
+        asyncio.run(load(query, entities))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        samples = timed(lambda: asyncio.run(load(query, entities)), args.repeat)
+        return statistics.median(samples), peak / 2**20
+
+    print(f"{args.sizes[-1]} rows per table")
+    print(f"{'list':<8} {'entities p50':>13} {'columns p50':>12} {'entities peak':>14} {'columns peak':>13}")
+    for label, entity_query, column_query in PROJECTION_CHECKS:
+        entity_ms, entity_mb = measure(entity_query, True)
+        column_ms, column_mb = measure(column_query, False)
+        print(f"{label:<8} {entity_ms:>10.1f} ms {column_ms:>9.1f} ms {entity_mb:>11.1f} MB {column_mb:>10.1f} MB")
+
+
+def bench_writes(args):
+    """Add and update peer throughput under concurrent writers, with a reader alongside"""
+    admin_id, token = create_user("bench-admin", "admin")
+    seed_clients(0, args.sizes[0], admin_id)
+    print(f"SQLITE_PROFILE={main.SQLITE_PROFILE}, journal_mode={journal_mode()}")
+
+    with Server() as server:
+        stop = threading.Event()
+        reads = []
+
+        def reader():
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                server.request("POST", f"/api/ab/peers?current=1&pageSize={args.page_size}", token)
+                reads.append((time.perf_counter() - t0) * 1000)
+
+        def writer(i, samples, errors):
+            for n in range(args.repeat):
+                peer = {"id": f"9{i:03}{n:05}", "alias": f"writer-{i}", "tags": ["bench"]}
+                for method, path in (("POST", "/api/ab/peer/add/bench"), ("PUT", "/api/ab/peer/update/bench")):
+                    t0 = time.perf_counter()
+                    try:
+                        if "error" in server.request(method, path, token, peer):
+                            errors.append(path)
+                    except urllib.error.HTTPError as e:
+                        errors.append(e.code)
+                    samples.append((time.perf_counter() - t0) * 1000)
+                    peer["note"] = "updated"
+
+        read_thread = threading.Thread(target=reader)
+        read_thread.start()
+        results = [([], []) for _ in range(args.concurrency)]
+        threads = [threading.Thread(target=writer, args=(i, *r)) for i, r in enumerate(results)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        read_thread.join()
+
+    samples = [x for r in results for x in r[0]]
+    errors = [x for r in results for x in r[1]]
+    print(f"{args.concurrency:>3} writers: {len(samples) / elapsed:>7.1f} writes/s, "
+          f"p50 {percentile(samples, 50):.2f} ms, p99 {percentile(samples, 99):.2f} ms, {len(errors)} failed")
+    print(f"{'reader':>11}: p50 {percentile(reads, 50):.2f} ms, p99 {percentile(reads, 99):.2f} ms")
+    return 1 if errors else 0
+
+
+def journal_mode() -> str:
+    with main.engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+
+
+# Read endpoints whose statement count must not grow with the data, as (method, path, as admin)
+QUERY_CHECKS = [
+    ("GET", "/api/ab/list", False),
+    ("POST", "/api/ab/peers?pageSize={page_size}", True),
+    ("POST", "/api/ab/peers?pageSize={page_size}", False),
+    ("POST", "/api/ab/peers?cursor=&pageSize={page_size}", False),
+    ("POST", "/api/ab/peers?tag=bench&pageSize={page_size}", False),
+    ("POST", "/api/ab/peers?alias=host&pageSize={page_size}", True),
+    ("GET", "/api/ab/changes?since=0", False),
+    ("GET", "/api/admin/users", True),
+    ("GET", "/api/admin/clients", True),
+    ("GET", "/api/admin/permissions/{first_client}", True),
+    ("GET", "/api/admin/groups/users", True),
+    ("GET", "/api/admin/group-permissions", True),
+]
+
+
+def bench_queries(args):
+    """SQL statements per request as the tables grow, exits non-zero on an N+1"""
+    admin_id, admin_token = create_user("bench-admin", "admin")
+    user_id, user_token = create_user("bench-user")
+    statements = [0]
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    event.listen(main.async_engine.sync_engine, "before_cursor_execute", count)
+    counts = {}  # check -> statements at each size
+    seeded = 0
+    first_client = None
+    with Server() as server:
+        for size in args.sizes:
+            ids = seed_clients(seeded, size, admin_id)
+            first_client = first_client or ids[0]
+            # The user can see every tenth client, and every new user can see the first one
+            seed_users(seeded // 10, size // 10, [first_client])
+            grant_read([user_id], ids[::10])
+            seeded = size
+            for method, path, as_admin in QUERY_CHECKS:
+                path = path.format(page_size=args.page_size, first_client=first_client)
+                token = admin_token if as_admin else user_token
+                server.request(method, path, token)  # warm the auth and permission caches
+                statements[0] = 0
+                server.request(method, path, token)
+                counts.setdefault((method, path, as_admin), []).append(statements[0])
+    event.remove(main.async_engine.sync_engine, "before_cursor_execute", count)
+
+    print(f"{'request':<58}" + "".join(f"{size:>9}" for size in args.sizes))
+    failed = []
+    for (method, path, as_admin), row in counts.items():
+        label = f"{method} {path} ({'admin' if as_admin else 'user'})"
+        print(f"{label:<58}" + "".join(f"{n:>9}" for n in row))
+        if row[-1] > row[0]:
+            failed.append(label)
+    if failed:
+        print(f"Statement count grows with table size: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+BENCHMARKS = {
+    "pagination": bench_pagination,
+    "login-storm": bench_login_storm,
+    "concurrency": bench_concurrency,
+    "large-page": bench_large_page,
+    "projection": bench_projection,
+    "queries": bench_queries,
+    "writes": bench_writes,
+}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="MultiDesk API server benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="Benchmark to run")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000],
+                        help="Table sizes to measure at")
+    parser.add_argument("--page-size", type=int, default=100, help="Peers per page")
+    parser.add_argument("--repeat", type=int, default=20, help="Requests per measurement")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients for load benchmarks")
+    parser.add_argument("--sync", action="store_true",
+                        help="concurrency: read through the sync session path the async engine replaced")
+    parser.add_argument("--stock-json", action="store_true",
+                        help="large-page: serialize with jsonable_encoder and JSONResponse instead of orjson")
+    args = parser.parse_args()
+
+    migrate.upgrade()
+    try:
+        return BENCHMARKS[args.benchmark](args)
+    finally:
+        main.engine.dispose()
+        _tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
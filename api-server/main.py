@@ -5,37 +5,810 @@ A self-hosted database-based address book system with user permissions.
 Compatible with RustDesk/MultiDesk address book API.
 """
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime, UniqueConstraint
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, ForeignKey, DateTime, Boolean, Index, UniqueConstraint, and_, or_, select, insert, update, delete, exists, literal, literal_column, bindparam, text, case, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.sql import func
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import asyncio
 import os
+import queue
+import threading
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+import base64
+import csv
+import io
 import json
+import logging
+import sqlite3
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, writes are then only serialized within each worker
+    fcntl = None
 
 # Configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./multidesk_ab.db")
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+CACHE_URL = os.getenv("CACHE_URL", "memory")  # memory, or sqlite:///path to share invalidations between workers
+CACHE_POLL_SECONDS = float(os.getenv("CACHE_POLL_SECONDS", "0.5"))  # how often workers pick up each other's invalidations
+CACHE_EVENT_RETENTION = 300  # seconds invalidation events stay in a shared backend
+REVOCATION_REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", "2"))  # how soon other workers see a revoked token
+REVOCATION_OVERLAP = timedelta(seconds=30)  # re-read window covering revocations that committed late
+REQUIRE_TOKEN_JTI = os.getenv("REQUIRE_TOKEN_JTI", "false").lower() == "true"  # reject tokens issued before sessions existed
+SESSION_PURGE_SECONDS = 3600  # how often expired sessions are deleted
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))  # seconds, 0 disables
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "10000"))  # entries kept by CACHE_URL=memory, e.g. read-your-writes records
+PERMISSION_CACHE_TTL = int(os.getenv("PERMISSION_CACHE_TTL", "60"))  # seconds, 0 disables
+PERMISSION_CACHE_SIZE = int(os.getenv("PERMISSION_CACHE_SIZE", "10000"))  # users
+BULK_MAX_PEERS = int(os.getenv("BULK_MAX_PEERS", "10000"))  # per bulk request
+BULK_LOOKUP_CHUNK = 500  # client IDs per IN (...) lookup, well under SQLite's bind limit
+BULK_HASH_CHUNK = 8  # peer passwords per password pool job, so logins get a turn between jobs
+EXPORT_BATCH_SIZE = BULK_LOOKUP_CHUNK  # rows fetched from the export cursor at a time
+AB_CHANGES_RETENTION_DAYS = int(os.getenv("AB_CHANGES_RETENTION_DAYS", "30"))
+AB_CHANGES_PURGE_EVERY = 1000  # revisions between purges of expired change log rows
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", "64"))  # waiting jobs before 503
+PASSWORD_NICE = int(os.getenv("PASSWORD_NICE", "10"))  # niceness of the password threads, 0 keeps the server's
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds, -1 disables
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", "0"))  # log statements slower than this, 0 disables
+PRESENCE_FLUSH_SECONDS = float(os.getenv("PRESENCE_FLUSH_SECONDS", "5"))  # seconds between batched presence writes
+PRESENCE_BUFFER_SIZE = int(os.getenv("PRESENCE_BUFFER_SIZE", "100000"))  # devices buffered between writes, more are dropped
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # bearer token required by /metrics, empty requires an admin's token
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")  # replica for address book reads, empty reads the primary
+READ_YOUR_WRITES_TTL = int(os.getenv("READ_YOUR_WRITES_TTL", "60"))  # seconds a writer's reads wait for the replica
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production")  # production (WAL, serialized writes) or legacy
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # ms a writer waits for the lock
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # bytes, 0 disables
+WRITE_QUEUE_TIMEOUT = float(os.getenv("WRITE_QUEUE_TIMEOUT", "30"))  # seconds a write waits for its turn before 503
+
+logger = logging.getLogger("multidesk")
+
+# Async drivers used by the request handlers for each sync DATABASE_URL backend
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def get_async_database_url(url: str) -> str:
+    """Swap the driver of DATABASE_URL for its asyncio counterpart"""
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None:
+        raise RuntimeError(f"No async driver known for {parsed.drivername}, set ASYNC_DATABASE_URL")
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or get_async_database_url(DATABASE_URL)
+ASYNC_DATABASE_READ_URL = os.getenv("ASYNC_DATABASE_READ_URL") or (
+    get_async_database_url(DATABASE_READ_URL) if DATABASE_READ_URL else ""
+)
 
 # Database setup
+# The sync engine serves create_all and scripts such as create_admin.py,
+# request handlers go through the async engine so DB I/O never blocks the loop.
+pool_options = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_recycle": DB_POOL_RECYCLE,
+}
+if make_url(ASYNC_DATABASE_URL).get_backend_name() == "sqlite":
+    # aiosqlite defaults to NullPool, which opens a connection (and thread) per request
+    pool_options["poolclass"] = AsyncAdaptedQueuePool
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options)
+# Address book reads go to the replica when one is configured, everything else to the primary
+read_engine = create_async_engine(ASYNC_DATABASE_READ_URL, **pool_options) if ASYNC_DATABASE_READ_URL else async_engine
+SQLITE_PRODUCTION = (
+    make_url(ASYNC_DATABASE_URL).get_backend_name() == "sqlite" and SQLITE_PROFILE == "production"
+)
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Put each new SQLite connection in WAL mode so readers never block on the writer"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is durable in WAL mode except for the last commits on power loss
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    finally:
+        cursor.close()
+
+if SQLITE_PRODUCTION:
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+    if read_engine is not async_engine:
+        event.listen(read_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
+class WriteSession(AsyncSession):
+    """Session that takes a turn in the write queue at its first write and gives it back at commit
+
+    Everything before the first INSERT/UPDATE/DELETE or flush of pending
+    objects runs outside the queue, so hash passwords before writing.
+    """
+    
+    _write_turn = False
+    
+    async def _take_write_turn(self):
+        if not self._write_turn:
+            await write_queue.acquire()
+            self._write_turn = True
+    
+    def _end_write_turn(self):
+        if self._write_turn:
+            self._write_turn = False
+            write_queue.release()
+    
+    def _has_changes(self) -> bool:
+        return bool(self.new or self.dirty or self.deleted)
+    
+    async def execute(self, statement, *args, **kwargs):
+        if getattr(statement, "is_dml", False):
+            await self._take_write_turn()
+        return await super().execute(statement, *args, **kwargs)
+    
+    async def flush(self, objects=None):
+        if self._has_changes():
+            await self._take_write_turn()
+        await super().flush(objects)
+    
+    async def commit(self):
+        if self._has_changes():
+            await self._take_write_turn()
+        try:
+            await super().commit()
+        finally:
+            self._end_write_turn()
+    
+    async def rollback(self):
+        try:
+            await super().rollback()
+        finally:
+            self._end_write_turn()
+    
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            self._end_write_turn()
+
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=WriteSession, autoflush=False, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(read_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+class PasswordPool:
+    """Bounded thread pool for bcrypt work so it never blocks the event loop"""
+    
+    def __init__(self, workers: int, queue_size: int, nice: int = 0):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0  # submitted and not yet finished
+        self.completed = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="password", initializer=lower_thread_priority, initargs=(nice,)
+        )
+    
+    async def run(self, fn, *args):
+        # Only touched from the event loop thread, so the counters need no lock
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, try again later")
+        self.pending += 1
+        try:
+            result, elapsed = await asyncio.get_running_loop().run_in_executor(self._executor, timed_call, fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+        stats = request_stats.get()
+        if stats is not None:
+            stats.bcrypt_seconds += elapsed
+        return result
+    
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": min(self.pending, self.workers),
+            "queued": max(self.pending - self.workers, 0),
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+def lower_thread_priority(nice: int):
+    """Renice the calling thread, so bcrypt only gets the CPU time request handling leaves over
+
+    Linux schedules threads individually, elsewhere this does nothing.
+    """
+    if nice <= 0 or not hasattr(os, "setpriority"):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), os.getpriority(os.PRIO_PROCESS, 0) + nice)
+    except OSError:
+        logger.warning("Could not lower the priority of password threads")
+
+def timed_call(fn, *args):
+    """Call fn and return (result, seconds it took), for timing work in other threads"""
+    start = time.perf_counter()
+    return fn(*args), time.perf_counter() - start
+
+password_pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE, PASSWORD_NICE)
+
+class WriteQueue:
+    """Lets one transaction at a time write, so SQLite writers queue here instead of on the file lock
+
+    A transaction takes its turn at its first write and hands it back when it
+    commits or rolls back (see WriteSession), so reads and password hashing
+    never hold it. Within a worker writers wait on an asyncio lock, between
+    workers on an exclusive flock of lock_path.
+    """
+    
+    def __init__(self, enabled: bool, lock_path: Optional[str], timeout: float):
+        self.enabled = enabled
+        self.lock_path = lock_path if enabled and fcntl is not None else None
+        self.timeout = timeout
+        self.waiting = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self._lock = asyncio.Lock()
+        self._lock_file = None
+    
+    async def acquire(self):
+        if not self.enabled:
+            return
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._lock.acquire(), self.timeout)
+            try:
+                await self._acquire_file(start + self.timeout)
+            except BaseException:
+                self._lock.release()
+                raise
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise HTTPException(status_code=503, detail="Database busy, try again later")
+        finally:
+            self.waiting -= 1
+        self.wait_seconds += time.perf_counter() - start
+    
+    async def _acquire_file(self, deadline: float):
+        """Take the flock shared with the other workers, polling so the event loop keeps running"""
+        if self.lock_path is None:
+            return
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, "a")
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.perf_counter() >= deadline:
+                    raise asyncio.TimeoutError
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+    
+    def release(self):
+        if not self.enabled:
+            return
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self.completed += 1
+        self._lock.release()
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "lock_file": self.lock_path,
+            "writing": self._lock.locked(),
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "wait_seconds": round(self.wait_seconds, 3)
+        }
+
+def write_lock_path(url: str) -> Optional[str]:
+    """Lock file next to a SQLite database, None for in-memory databases"""
+    database = make_url(url).database
+    if not database or database == ":memory:":
+        return None
+    return f"{database}.write-lock"
+
+# Only the SQLite production profile serializes writes, other servers handle concurrent writers themselves
+write_queue = WriteQueue(SQLITE_PRODUCTION, write_lock_path(ASYNC_DATABASE_URL), WRITE_QUEUE_TIMEOUT)
+
+# Caching
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a TTL"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+    
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def discard_where(self, predicate):
+        """Drop every entry whose value matches predicate"""
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(v)]:
+                del self._data[key]
+    
+    def values(self) -> list:
+        """Snapshot of the cached values, including expired ones"""
+        with self._lock:
+            return [v for _, v in self._data.values()]
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+# Verified token -> AuthUser, so polling clients skip the JWT decode and user lookup
+auth_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+# User id -> {client_id string: permission_type or None}, filled in as clients are checked
+permission_cache = TTLCache(PERMISSION_CACHE_SIZE, PERMISSION_CACHE_TTL)
+
+class MemoryCacheBackend:
+    """Cache backend for a single worker: values live in this process, invalidations stay here"""
+    
+    name = "memory"
+    shared = False
+    
+    def __init__(self):
+        self.published = 0
+        self.received = 0
+        self._values = TTLCache(CACHE_SIZE, float("inf"))
+    
+    async def get(self, key: str):
+        return self._values.get(key)
+    
+    def set(self, key: str, value, ttl: float):
+        self._values.set(key, value, ttl=ttl)
+    
+    def publish(self, kind: str, key=None):
+        self.published += 1
+    
+    async def poll(self) -> list:
+        return []
+    
+    def close(self):
+        pass
+    
+    def stats(self) -> dict:
+        return {"backend": self.name, "published": self.published, "received": self.received}
+
+class SQLiteCacheBackend(MemoryCacheBackend):
+    """Cache backend shared by the workers on one host through a SQLite file
+
+    Values are JSON rows read on every get, invalidations are appended to an
+    event table that every worker polls for the ones published by the others.
+    None of it runs on the event loop: gets and polls go to a worker thread,
+    sets and publishes are queued for a writer thread (set and publish are
+    called from commit hooks and handlers that must not wait on the file
+    lock). Until a set is written, this worker reads it back from memory.
+    """
+    
+    name = "sqlite"
+    shared = True
+    
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.worker = uuid.uuid4().hex
+        self._last_event = None  # id of the newest event seen, None until the first poll
+        self._purged_at = time.time()
+        self._local = threading.local()
+        self._unwritten = {}  # key -> value set here and still queued
+        self._unwritten_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="cache-writer", daemon=True)
+        self._writer.start()
+    
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_events "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT, kind TEXT, key TEXT, created_at REAL)"
+            )
+            self._local.conn = conn
+        return conn
+    
+    def _write_loop(self):
+        while True:
+            write = self._writes.get()
+            if write is None:
+                return
+            sql, params, key = write
+            try:
+                self._conn().execute(sql, params)
+            except Exception:
+                logger.exception("Writing to the cache backend failed")
+            if key is not None:
+                with self._unwritten_lock:
+                    if self._unwritten.get(key, (None,))[0] is params:
+                        del self._unwritten[key]
+    
+    async def get(self, key: str):
+        with self._unwritten_lock:
+            unwritten = self._unwritten.get(key)
+        if unwritten is not None:
+            return unwritten[1]
+        return await asyncio.to_thread(self._get, key)
+    
+    def _get(self, key: str):
+        row = self._conn().execute(
+            "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set(self, key: str, value, ttl: float):
+        params = (key, json.dumps(value), time.time() + ttl)
+        with self._unwritten_lock:
+            self._unwritten[key] = (params, value)
+        self._writes.put(("INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)", params, key))
+    
+    def publish(self, kind: str, key=None):
+        self._writes.put((
+            "INSERT INTO cache_events (worker, kind, key, created_at) VALUES (?, ?, ?, ?)",
+            (self.worker, kind, json.dumps(key), time.time()),
+            None
+        ))
+        self.published += 1
+    
+    async def poll(self) -> list:
+        """(kind, key) events published by other workers since the last poll"""
+        return await asyncio.to_thread(self._poll)
+    
+    def _poll(self) -> list:
+        conn = self._conn()
+        if self._last_event is None:
+            # Start from now, this worker's caches are empty anyway
+            self._last_event = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()[0]
+            return []
+        rows = conn.execute(
+            "SELECT id, worker, kind, key FROM cache_events WHERE id > ? ORDER BY id", (self._last_event,)
+        ).fetchall()
+        if rows:
+            self._last_event = rows[-1][0]
+        events = [(kind, json.loads(key)) for _, worker, kind, key in rows if worker != self.worker]
+        self.received += len(events)
+        now = time.time()
+        if now - self._purged_at > CACHE_EVENT_RETENTION:
+            conn.execute("DELETE FROM cache_events WHERE created_at < ?", (now - CACHE_EVENT_RETENTION,))
+            conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+            self._purged_at = now
+        return events
+    
+    def close(self):
+        """Write out everything still queued"""
+        self._writes.put(None)
+        self._writer.join()
+    
+    def stats(self) -> dict:
+        return dict(super().stats(), queued=self._writes.qsize())
+
+def make_cache_backend(url: str):
+    if url == "memory":
+        return MemoryCacheBackend()
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database:
+        return SQLiteCacheBackend(parsed.database)
+    raise RuntimeError(f"Unsupported CACHE_URL {url}, use memory or sqlite:///path")
+
+cache_backend = make_cache_backend(CACHE_URL)
+
+def apply_invalidation(kind: str, key=None):
+    """Drop this worker's cached entries named by an invalidation event"""
+    if kind == "user":
+        auth_cache.discard_where(lambda u: u.id == key)
+        permission_cache.discard(key)
+    elif kind == "permissions":
+        if key is None:
+            permission_cache.clear()
+        else:
+            permission_cache.discard(key)
+    elif kind == "client":
+        for known in permission_cache.values():
+            known.pop(key, None)
+
+def invalidate(kind: str, key=None):
+    """Apply an invalidation here and hand it to the other workers through the cache backend"""
+    apply_invalidation(kind, key)
+    cache_backend.publish(kind, key)
+
+async def follow_invalidations():
+    """Apply the invalidations other workers publish, for shared cache backends"""
+    while True:
+        await asyncio.sleep(CACHE_POLL_SECONDS)
+        try:
+            for kind, key in await cache_backend.poll():
+                apply_invalidation(kind, key)
+        except Exception:
+            logger.exception("Reading cache invalidations failed")
+
+# Address book reads served by each side, see get_read_db
+read_routing = {"replica": 0, "primary": 0}
+
+class RevocationList:
+    """Revoked token ids mirrored from auth_sessions, so checking a token costs no query
+    
+    Every worker polls for revocations newer than its last poll, so a token
+    revoked through any worker is rejected everywhere within the interval.
+    """
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.refreshes = 0
+        self._revoked = {}  # jti -> expiry, forgotten once the token expires anyway
+        self._since = None  # start of the last poll, minus REVOCATION_OVERLAP
+    
+    def __contains__(self, jti) -> bool:
+        return jti in self._revoked
+    
+    def update(self, rows):
+        """Add (jti, expires_at) pairs, e.g. right after revoking them in this worker"""
+        for jti, expires_at in rows:
+            self._revoked[jti] = expires_at
+    
+    async def refresh(self):
+        """Pull the revocations made since the last refresh, by any worker"""
+        started = datetime.utcnow()
+        query = select(AuthSession.jti, AuthSession.expires_at).where(
+            AuthSession.revoked_at.is_not(None),
+            AuthSession.expires_at > started
+        )
+        if self._since is not None:
+            query = query.where(AuthSession.revoked_at > self._since)
+        async with AsyncSessionLocal() as db:
+            self.update((await db.execute(query)).all())
+        self._revoked = {jti: expires_at for jti, expires_at in self._revoked.items() if expires_at > started}
+        self._since = started - REVOCATION_OVERLAP
+        self.refreshes += 1
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Refreshing revoked tokens failed")
+    
+    def stats(self) -> dict:
+        return {"revoked": len(self._revoked), "refreshes": self.refreshes}
+
+revoked_tokens = RevocationList(REVOCATION_REFRESH_SECONDS)
+
+class PresenceBuffer:
+    """Latest heartbeat and sysinfo per device, written to peer_status in batches
+    
+    Only the newest report of each device survives until the next flush, so
+    thousands of heartbeating devices cost one batched upsert per interval.
+    """
+    
+    def __init__(self, interval: float, maxsize: int):
+        self.interval = interval
+        self.maxsize = maxsize
+        self.received = 0
+        self.dropped = 0
+        self.written = 0
+        self._pending = {}  # client_id -> peer_status row
+    
+    def record(self, client_id: str, **sysinfo):
+        entry = self._pending.get(client_id)
+        if entry is None:
+            if len(self._pending) >= self.maxsize:
+                self.dropped += 1
+                return
+            entry = self._pending[client_id] = {"client_id": client_id, **dict.fromkeys(SYSINFO_FIELDS)}
+        entry["last_seen"] = datetime.utcnow()
+        # Fields a report leaves out keep what an earlier one said, as they do in peer_status
+        entry.update((field, value) for field, value in sysinfo.items() if value is not None)
+        self.received += 1
+    
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if pending:
+            self.written += await write_peer_status(list(pending.values()))
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                # Presence is best effort, the devices report again soon
+                logger.exception("Writing peer status failed")
+    
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "received": self.received,
+            "dropped": self.dropped,
+            "written": self.written
+        }
+
+presence = PresenceBuffer(PRESENCE_FLUSH_SECONDS, PRESENCE_BUFFER_SIZE)
+
+# Metrics
+class RequestStats:
+    """Work done on behalf of the current request"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.route = "unmatched"  # route template, known once routing is done
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+
+# Set by the metrics middleware, seen by the SQLAlchemy events and the password pool
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+class Metrics:
+    """Per-route request metrics in the Prometheus text exposition format
+
+    Only updated from the event loop thread, so no locking is needed.
+    """
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self.requests = {}   # (method, route, status code) -> count
+        self.latency = {}    # (method, route) -> [bucket counts..., sum, count]
+        self.work = {}       # (method, route) -> [statements, db seconds, bcrypt seconds]
+    
+    def observe(self, method: str, stats: RequestStats, status_code: int, seconds: float):
+        key = (method, stats.route)
+        self.requests[key + (status_code,)] = self.requests.get(key + (status_code,), 0) + 1
+        latency = self.latency.setdefault(key, [0] * len(self.BUCKETS) + [0.0, 0])
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                latency[i] += 1
+        latency[-2] += seconds
+        latency[-1] += 1
+        work = self.work.setdefault(key, [0, 0.0, 0.0])
+        work[0] += stats.statements
+        work[1] += stats.db_seconds
+        work[2] += stats.bcrypt_seconds
+    
+    def render(self) -> str:
+        def labels(method, route, **extra):
+            pairs = {"method": method, "route": route, **extra}
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs.items()) + "}"
+        
+        lines = [
+            "# HELP multidesk_http_requests_total Requests handled, by route and status",
+            "# TYPE multidesk_http_requests_total counter",
+        ]
+        for (method, route, status_code), count in sorted(self.requests.items()):
+            lines.append(f"multidesk_http_requests_total{labels(method, route, status=status_code)} {count}")
+        lines += [
+            "# HELP multidesk_http_request_duration_seconds Time until the response started",
+            "# TYPE multidesk_http_request_duration_seconds histogram",
+        ]
+        for (method, route), latency in sorted(self.latency.items()):
+            for bound, count in zip(self.BUCKETS, latency):
+                lines.append(f"multidesk_http_request_duration_seconds_bucket{labels(method, route, le=bound)} {count}")
+            lines.append(f"multidesk_http_request_duration_seconds_bucket{labels(method, route, le='+Inf')} {latency[-1]}")
+            lines.append(f"multidesk_http_request_duration_seconds_sum{labels(method, route)} {latency[-2]}")
+            lines.append(f"multidesk_http_request_duration_seconds_count{labels(method, route)} {latency[-1]}")
+        for i, (name, help) in enumerate([
+            ("multidesk_sql_statements_total", "SQL statements executed"),
+            ("multidesk_sql_duration_seconds_total", "Time spent executing SQL statements"),
+            ("multidesk_bcrypt_duration_seconds_total", "Time spent hashing and verifying passwords"),
+        ]):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+            for (method, route), work in sorted(self.work.items()):
+                lines.append(f"{name}{labels(method, route)} {work[i]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["statement_start"].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning("Slow query (%.1f ms) in %s: %s", elapsed * 1000,
+                       stats.path if stats else "background", " ".join(statement.split())[:500])
+
+for statement_engine in {async_engine, read_engine}:
+    event.listen(statement_engine.sync_engine, "before_cursor_execute", start_statement_timer)
+    event.listen(statement_engine.sync_engine, "after_cursor_execute", record_statement)
+
 # FastAPI app
-app = FastAPI(title="MultiDesk Address Book API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await revoked_tokens.refresh()
+    except Exception:
+        logger.exception("Loading revoked tokens failed, retrying in the background")
+    tasks = [
+        asyncio.create_task(revoked_tokens.run()),
+        asyncio.create_task(purge_sessions_periodically()),
+        asyncio.create_task(presence.run())
+    ]
+    if read_engine is not async_engine and not cache_backend.shared:
+        logger.warning("DATABASE_READ_URL without a shared CACHE_URL: with several workers, "
+                       "a user's reads may miss their own recent writes")
+    if cache_backend.shared:
+        await cache_backend.poll()
+        tasks.append(asyncio.create_task(follow_invalidations()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await presence.flush()
+    await asyncio.to_thread(cache_backend.close)
+
+app = FastAPI(title="MultiDesk Address Book API", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -46,6 +819,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class MetricsMiddleware:
+    """Time each request and attribute its SQL and bcrypt work to its route"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        stats = RequestStats(scope["path"])
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        status_code = 500
+        elapsed = None
+        
+        async def send_and_time(message):
+            nonlocal status_code, elapsed
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                elapsed = time.perf_counter() - start
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_and_time)
+        finally:
+            request_stats.reset(token)
+            # Label by route template rather than path so IDs don't create new series
+            route = scope.get("route")
+            if route is not None:
+                stats.route = route.path
+            metrics.observe(scope["method"], stats, status_code,
+                            elapsed if elapsed is not None else time.perf_counter() - start)
+
+app.add_middleware(MetricsMiddleware)
+
 # Security
 security = HTTPBearer()
 
@@ -62,7 +871,7 @@ class User(Base):
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     
     # Relationships
-    client_permissions = relationship("UserClientPermission", back_populates="user")
+    client_permissions = relationship("UserClientPermission", foreign_keys="UserClientPermission.user_id", back_populates="user")
     created_clients = relationship("ClientID", foreign_keys="ClientID.created_by", back_populates="creator")
 
 class ClientID(Base):
@@ -72,7 +881,7 @@ class ClientID(Base):
     client_id = Column(String(255), unique=True, nullable=False, index=True)
     alias = Column(String(255))
     description = Column(Text)
-    tags = Column(Text)  # JSON array
+    tags = Column(Text)  # Legacy JSON array, copied into peer_tags by migration 3 and no longer written
     password_hash = Column(String(255))  # Optional
     notes = Column(Text)
     created_by = Column(Integer, ForeignKey("users.id"))
@@ -83,6 +892,15 @@ class ClientID(Base):
     creator = relationship("User", foreign_keys=[created_by], back_populates="created_clients")
     user_permissions = relationship("UserClientPermission", back_populates="client")
 
+class PeerTag(Base):
+    __tablename__ = "peer_tags"
+    
+    # Primary key serves per-client loads, ix_peer_tags_tag serves tag filters
+    client_id = Column(Integer, ForeignKey("client_ids.id"), primary_key=True)
+    tag = Column(String(255), primary_key=True)
+    
+    __table_args__ = (Index("ix_peer_tags_tag", "tag", "client_id"),)
+
 class UserClientPermission(Base):
     __tablename__ = "user_client_permissions"
     
@@ -97,10 +915,196 @@ class UserClientPermission(Base):
     user = relationship("User", foreign_keys=[user_id], back_populates="client_permissions")
     client = relationship("ClientID", back_populates="user_permissions")
     
+    # Also serves as the (user_id, client_id) index for per-user lookups
     __table_args__ = (UniqueConstraint('user_id', 'client_id', name='_user_client_uc'),)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+class UserGroup(Base):
+    __tablename__ = "user_groups"
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), unique=True, nullable=False)
+    description = Column(Text)
+    created_at = Column(DateTime, server_default=func.now())
+
+class UserGroupMember(Base):
+    __tablename__ = "user_group_members"
+    
+    group_id = Column(Integer, ForeignKey("user_groups.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True, index=True)
+
+class ClientGroup(Base):
+    __tablename__ = "client_groups"
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), unique=True, nullable=False)
+    description = Column(Text)
+    created_at = Column(DateTime, server_default=func.now())
+
+class ClientGroupMember(Base):
+    __tablename__ = "client_group_members"
+    
+    group_id = Column(Integer, ForeignKey("client_groups.id"), primary_key=True)
+    client_id = Column(Integer, ForeignKey("client_ids.id"), primary_key=True, index=True)
+
+class GroupPermission(Base):
+    __tablename__ = "group_permissions"
+    
+    id = Column(Integer, primary_key=True)
+    user_group_id = Column(Integer, ForeignKey("user_groups.id"), nullable=False)
+    client_group_id = Column(Integer, ForeignKey("client_groups.id"), nullable=False)
+    permission_type = Column(String(50), default="read")  # read, write, admin
+    granted_by = Column(Integer, ForeignKey("users.id"))
+    granted_at = Column(DateTime, server_default=func.now())
+    
+    __table_args__ = (UniqueConstraint("user_group_id", "client_group_id", name="_group_grant_uc"),)
+
+class EffectivePermission(Base):
+    __tablename__ = "effective_permissions"
+    
+    # Strongest of each user's direct and group grants on a client, maintained by
+    # refresh_effective_permissions. Every access check reads this table only.
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    client_id = Column(Integer, ForeignKey("client_ids.id"), primary_key=True, index=True)
+    permission_type = Column(String(50), nullable=False)
+
+class AddressBookRevision(Base):
+    __tablename__ = "ab_revisions"
+    
+    # Bumped in the same transaction as every change that can alter a peer list
+    guid = Column(String(255), primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+    # Change log rows up to here were purged, older clients need a full resync
+    compacted_revision = Column(Integer, nullable=False, default=0)
+
+# user_id of change log rows about the peer itself rather than one user's access to it
+ALL_USERS = 0
+
+class AddressBookChange(Base):
+    __tablename__ = "ab_changes"
+    
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False)
+    # NULL with a user_id means that user must resync everything (e.g. their role changed)
+    client_id = Column(String(255))
+    user_id = Column(Integer, nullable=False, default=ALL_USERS)
+    deleted = Column(Boolean, nullable=False, default=False)
+    changed_at = Column(DateTime, server_default=func.now())
+    
+    __table_args__ = (
+        Index("ix_ab_changes_revision", "revision"),
+        Index("ix_ab_changes_client_user", "client_id", "user_id"),
+    )
+
+class PeerStatus(Base):
+    __tablename__ = "peer_status"
+    
+    # Presence reported by the device itself through /api/heartbeat and /api/sysinfo
+    client_id = Column(String(255), primary_key=True)
+    last_seen = Column(DateTime, nullable=False)
+    hostname = Column(String(255))
+    username = Column(String(255))
+    platform = Column(String(255))
+
+# Fields a device reports through /api/sysinfo, shown with each peer
+SYSINFO_FIELDS = ("hostname", "username", "platform")
+
+class AuthSession(Base):
+    __tablename__ = "auth_sessions"
+    
+    # One row per token issued at login, keyed by the jti claim it carries.
+    # user_id is no foreign key so a deleted user's sessions stay revoked until they expire.
+    jti = Column(String(32), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime)
+    
+    __table_args__ = (
+        Index("ix_auth_sessions_user", "user_id"),
+        Index("ix_auth_sessions_revoked_at", "revoked_at"),
+        Index("ix_auth_sessions_expires_at", "expires_at"),
+    )
+
+# Whether the SQLite client_search FTS5 table from the peer search migration
+# exists, looked up on the first search rather than at import
+peer_search_fts = None
+
+async def has_peer_search_fts(db: AsyncSession) -> bool:
+    global peer_search_fts
+    if peer_search_fts is None:
+        peer_search_fts = async_engine.dialect.name == "sqlite" and (await db.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'client_search'")
+        )).first() is not None
+    return peer_search_fts
+
+def peer_search_filter(column: str, term: str, fts: bool):
+    """Case-insensitive substring match of term against a client_ids column
+
+    Served by the trigram indexes on PostgreSQL and by the client_search
+    FTS5 table on SQLite when fts is set.
+    """
+    if fts and len(term) >= 3:
+        # Quote the term so FTS5 treats it as one literal string, trigram matches any substring
+        match = '%s : "%s"' % (column, term.replace('"', '""'))
+        # One bind name per column, a query can filter on several
+        return ClientID.id.in_(
+            select(literal_column("rowid")).select_from(text("client_search")).where(
+                text(f"client_search MATCH :{column}_match").bindparams(**{f"{column}_match": match})
+            )
+        )
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return getattr(ClientID, column).ilike(f"%{escaped}%", escape="\\")
+
+PERMISSION_RANKS = {"read": 1, "write": 2, "admin": 3}
+
+def permission_rank(column):
+    return case(PERMISSION_RANKS, value=column, else_=1)
+
+def effective_permission_statements(user_scope=None, client_scope=None) -> list:
+    """Statements recomputing effective_permissions for the given users and clients
+
+    Scopes are lists of ids or SELECTs of ids, None means everyone. Rows in
+    scope are deleted and re-derived from the direct and group grants.
+    """
+    def scoped(user_column, client_column):
+        conditions = []
+        if user_scope is not None:
+            conditions.append(user_column.in_(user_scope))
+        if client_scope is not None:
+            conditions.append(client_column.in_(client_scope))
+        return conditions
+    
+    direct = select(
+        UserClientPermission.user_id, UserClientPermission.client_id,
+        permission_rank(UserClientPermission.permission_type).label("rank")
+    ).where(*scoped(UserClientPermission.user_id, UserClientPermission.client_id))
+    via_groups = select(
+        UserGroupMember.user_id, ClientGroupMember.client_id,
+        permission_rank(GroupPermission.permission_type).label("rank")
+    ).join(
+        UserGroupMember, UserGroupMember.group_id == GroupPermission.user_group_id
+    ).join(
+        ClientGroupMember, ClientGroupMember.group_id == GroupPermission.client_group_id
+    ).where(*scoped(UserGroupMember.user_id, ClientGroupMember.client_id))
+    grants = union_all(direct, via_groups).subquery()
+    strongest = select(
+        grants.c.user_id, grants.c.client_id,
+        case({rank: name for name, rank in PERMISSION_RANKS.items()}, value=func.max(grants.c.rank))
+    ).group_by(grants.c.user_id, grants.c.client_id)
+    
+    effective = EffectivePermission.__table__
+    return [
+        delete(effective).where(*scoped(effective.c.user_id, effective.c.client_id)),
+        insert(effective).from_select(["user_id", "client_id", "permission_type"], strongest),
+    ]
+
+async def refresh_effective_permissions(db: AsyncSession, user_scope=None, client_scope=None):
+    """Recompute effective access in scope within the caller's transaction"""
+    for stmt in effective_permission_statements(user_scope, client_scope):
+        await db.execute(stmt)
+
+# Tables are created and upgraded by migrate.py at deploy time, importing this
+# module never touches the database.
 
 # Pydantic Models
 class UserCreate(BaseModel):
@@ -128,18 +1132,56 @@ class ClientIDUpdate(BaseModel):
     password: Optional[str] = None
     notes: Optional[str] = None
 
+class UserUpdate(BaseModel):
+    email: Optional[str] = None
+    role: Optional[str] = None
+    password: Optional[str] = None
+
 class PermissionGrant(BaseModel):
     user_id: int
     client_id: int
     permission_type: str = "read"  # read, write, admin
 
+class BulkPermissionGrant(BaseModel):
+    user_id: int
+    client_ids: Optional[List[int]] = None  # clients to grant, and/or
+    tag: Optional[str] = None               # every client carrying this tag
+    permission_type: str = "read"  # read, write, admin
+
+class BulkPermissionRevoke(BaseModel):
+    user_id: int
+    client_ids: Optional[List[int]] = None
+    tag: Optional[str] = None
+
+class GroupCreate(BaseModel):
+    name: str
+    description: Optional[str] = None
+
+class GroupMembers(BaseModel):
+    add: List[int] = []     # user or client ids to add
+    remove: List[int] = []  # user or client ids to remove
+
+class GroupPermissionGrant(BaseModel):
+    user_group_id: int
+    client_group_id: int
+    permission_type: str = "read"  # read, write, admin
+
+class GroupPermissionRevoke(BaseModel):
+    user_group_id: int
+    client_group_id: int
+
+class AuthUser(NamedTuple):
+    """Snapshot of the authenticated user, safe to share across requests"""
+    id: int
+    username: str
+    email: Optional[str]
+    role: str
+    jti: Optional[str] = None  # session id of the token, None for tokens issued without one
+
 # Helper functions
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -147,15 +1189,51 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
-def create_access_token(data: dict):
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    return await password_pool.run(get_password_hash, password)
+
+def get_password_hashes(passwords: List[str]) -> List[str]:
+    return [get_password_hash(p) for p in passwords]
+
+def encode_cursor(client_id: str, id: int) -> str:
+    """Encode the last (client_id, id) of a page as an opaque cursor"""
+    raw = json.dumps([client_id, id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Decode a cursor from encode_cursor, returns None if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        client_id, id = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(client_id, str) or not isinstance(id, int):
+        return None
+    return client_id, id
+
+def create_access_token(data: dict, expire: Optional[datetime] = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = expire or datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+def invalidate_user(user_id: int):
+    """Drop cached principals for a user after their role changes or they are deleted"""
+    invalidate("user", user_id)
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
     token = credentials.credentials
+    cached = auth_cache.get(token)
+    if cached is not None:
+        if cached.jti in revoked_tokens:
+            auth_cache.discard(token)
+            raise HTTPException(status_code=401, detail="Token has been revoked")
+        return cached
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -163,43 +1241,346 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    if payload.get("jti") in revoked_tokens:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    if REQUIRE_TOKEN_JTI and not payload.get("jti"):
+        # Issued before sessions existed, so it cannot be revoked
+        raise HTTPException(status_code=401, detail="Token predates sessions, log in again")
     
-    user = db.query(User).filter(User.username == username).first()
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
+    # Hand the connection back to the pool, requests queued for the writer must not sit on one
+    await db.close()
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
-    return user
+    
+    auth_user = AuthUser(id=user.id, username=user.username, email=user.email, role=user.role, jti=payload.get("jti"))
+    # Never keep a token cached past its own expiry
+    expires_at = payload.get("exp")
+    auth_cache.set(token, auth_user, ttl=expires_at - time.time() if expires_at else None)
+    return auth_user
+
+async def get_write_db(current_user: AuthUser = Depends(get_current_user)):
+    """Session for endpoints that write, tagged with the user for read-your-writes (see remember_write)"""
+    async with AsyncSessionLocal() as db:
+        db.info["user_id"] = current_user.id
+        yield db
+
+async def get_read_db(current_user: AuthUser = Depends(get_current_user)):
+    """Replica session for address book reads
+
+    Falls back to the primary while the replica has not yet replayed the
+    revision of the user's own last write, so their edits show up at once.
+    """
+    if read_engine is not async_engine:
+        written = await cache_backend.get(f"recent_write:{current_user.id}")
+        async with AsyncReadSessionLocal() as db:
+            if written is not None:
+                # Only users who wrote recently pay for this check, the endpoint reuses its result
+                db.info["ab_revision_read"] = await get_ab_revision(db)
+            if written is None or db.info["ab_revision_read"] >= written:
+                read_routing["replica"] += 1
+                yield db
+                return
+        read_routing["primary"] += 1
+    async with AsyncSessionLocal() as db:
+        yield db
+
+@event.listens_for(Session, "after_commit")
+def remember_write(session):
+    """Record the revision a user's write committed, for get_read_db"""
+    revision = session.info.pop("ab_revision", None)
+    if revision is not None and "user_id" in session.info and read_engine is not async_engine:
+        cache_backend.set(f"recent_write:{session.info['user_id']}", revision, READ_YOUR_WRITES_TTL)
 
-def check_permission(user: User, client: ClientID, permission: str, db: Session):
-    """Check if user has permission on client"""
+async def revoke_sessions(db: AsyncSession, *criteria) -> List[tuple]:
+    """Revoke the live sessions matching criteria within the caller's transaction
+
+    Returns their (jti, expires_at), to hand to revoked_tokens.update once committed.
+    """
+    now = datetime.utcnow()
+    return (await db.execute(
+        update(AuthSession).where(
+            AuthSession.revoked_at.is_(None), AuthSession.expires_at > now, *criteria
+        ).values(revoked_at=now).returning(AuthSession.jti, AuthSession.expires_at)
+    )).all()
+
+async def purge_expired_sessions() -> int:
+    """Delete sessions past their expiry, their tokens are rejected by jwt.decode anyway"""
+    async with AsyncSessionLocal() as db:
+        purged = (await db.execute(delete(AuthSession).where(AuthSession.expires_at < datetime.utcnow()))).rowcount
+        await db.commit()
+    return purged
+
+async def purge_sessions_periodically():
+    while True:
+        await asyncio.sleep(SESSION_PURGE_SECONDS)
+        try:
+            await purge_expired_sessions()
+        except Exception:
+            logger.exception("Purging expired sessions failed")
+
+def sessions_revoked(rows: List[tuple]):
+    """Reject committed revocations in this worker at once, other workers follow on their next refresh"""
+    revoked_tokens.update(rows)
+    jtis = {jti for jti, _ in rows}
+    auth_cache.discard_where(lambda u: u.jti in jtis)
+
+def check_permission(user: AuthUser, permission_type: Optional[str], permission: str) -> bool:
+    """Check if user's grant on a client (None when there is none) allows permission"""
     if user.role == "admin":
         return True
     
     # Check direct permissions
-    perm = db.query(UserClientPermission).filter(
-        UserClientPermission.user_id == user.id,
-        UserClientPermission.client_id == client.id
-    ).first()
-    
-    if perm:
+    if permission_type:
         if permission == "read":
             return True
-        elif permission == "write" and perm.permission_type in ["write", "admin"]:
+        elif permission == "write" and permission_type in ["write", "admin"]:
             return True
-        elif permission == "admin" and perm.permission_type == "admin":
+        elif permission == "admin" and permission_type == "admin":
             return True
     
     return False
 
+async def get_clients_for_user(user: AuthUser, client_ids: List[str], db: AsyncSession) -> dict:
+    """Fetch clients by client_id along with user's grant on each, in one query
+
+    Returns {client_id: (ClientID, permission_type)} for the clients that exist.
+    Grants are remembered in permission_cache, so once they are known only the
+    clients themselves have to be loaded.
+    """
+    if user.role == "admin":
+        clients = (await db.execute(select(ClientID).where(ClientID.client_id.in_(client_ids)))).scalars().all()
+        return {c.client_id: (c, None) for c in clients}
+    
+    known = permission_cache.get(user.id)
+    if known is None:
+        known = {}
+        permission_cache.set(user.id, known)
+    
+    if all(c in known for c in client_ids):
+        clients = (await db.execute(select(ClientID).where(ClientID.client_id.in_(client_ids)))).scalars().all()
+        return {c.client_id: (c, known[c.client_id]) for c in clients}
+    
+    rows = (await db.execute(
+        select(ClientID, EffectivePermission.permission_type).outerjoin(
+            EffectivePermission, and_(
+                EffectivePermission.client_id == ClientID.id,
+                EffectivePermission.user_id == user.id
+            )
+        ).where(ClientID.client_id.in_(client_ids))
+    )).all()
+    for client, permission_type in rows:
+        known[client.client_id] = permission_type
+    return {client.client_id: (client, permission_type) for client, permission_type in rows}
+
+def forget_client(client_id: str):
+    """Drop a deleted client from every cached permission map"""
+    invalidate("client", client_id)
+
+def dialect_insert(model):
+    """INSERT supporting ON CONFLICT clauses on the configured backend"""
+    if async_engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+async def get_ab_revision(db: AsyncSession, guid: str = "default") -> int:
+    revision = (await db.execute(
+        select(AddressBookRevision.revision).where(AddressBookRevision.guid == guid)
+    )).scalar()
+    return revision or 0
+
+async def read_ab_revision(db: AsyncSession) -> int:
+    """Revision for a read's ETag, the one get_read_db already checked on this session if any"""
+    revision = db.info.get("ab_revision_read")
+    return revision if revision is not None else await get_ab_revision(db)
+
+async def bump_ab_revision(db: AsyncSession, guid: str = "default") -> int:
+    """Advance the address book revision within the caller's transaction"""
+    stmt = dialect_insert(AddressBookRevision).values(guid=guid, revision=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AddressBookRevision.guid],
+        set_={"revision": AddressBookRevision.revision + 1}
+    ).returning(AddressBookRevision.revision)
+    revision = (await db.execute(stmt)).scalar()
+    if guid == "default":
+        db.info["ab_revision"] = revision
+    return revision
+
+async def log_ab_changes(db: AsyncSession, changes: List[tuple], deleted: bool = False, guid: str = "default") -> int:
+    """Bump the revision and record (client_id, user_id) changes at it
+
+    Each change replaces the older log row for the same pair, so the log holds
+    at most one row per peer plus one per user whose access to it changed.
+    """
+    revision = await bump_ab_revision(db, guid)
+    if changes:
+        pairs = [{"c": client_id, "u": user_id} for client_id, user_id in changes if client_id is not None]
+        if pairs:
+            await db.execute(
+                delete(AddressBookChange.__table__).where(
+                    AddressBookChange.client_id == bindparam("c"),
+                    AddressBookChange.user_id == bindparam("u")
+                ),
+                pairs
+            )
+        await db.execute(insert(AddressBookChange.__table__), [
+            {"revision": revision, "client_id": client_id, "user_id": user_id, "deleted": deleted}
+            for client_id, user_id in changes
+        ])
+    if revision % AB_CHANGES_PURGE_EVERY == 0:
+        await purge_ab_changes(db, guid)
+    return revision
+
+async def purge_ab_changes(db: AsyncSession, guid: str = "default"):
+    """Drop change log rows past retention and raise the resync floor past them"""
+    cutoff = datetime.utcnow() - timedelta(days=AB_CHANGES_RETENTION_DAYS)
+    floor = (await db.execute(
+        select(func.max(AddressBookChange.revision)).where(AddressBookChange.changed_at < cutoff)
+    )).scalar()
+    if floor is None:
+        return
+    await db.execute(delete(AddressBookChange).where(AddressBookChange.revision <= floor))
+    await db.execute(update(AddressBookRevision).where(
+        AddressBookRevision.guid == guid,
+        AddressBookRevision.compacted_revision < floor
+    ).values(compacted_revision=floor))
+
+async def load_peer_tags(db: AsyncSession, ids: Optional[List[int]] = None) -> dict:
+    """Tags of each client (all clients when ids is None) by primary key, untagged ones are left out"""
+    query = select(PeerTag.client_id, PeerTag.tag).order_by(PeerTag.client_id, PeerTag.tag)
+    chunks = [None] if ids is None else [ids[i:i + BULK_LOOKUP_CHUNK] for i in range(0, len(ids), BULK_LOOKUP_CHUNK)]
+    tags = {}
+    for chunk in chunks:
+        rows = await db.execute(query if chunk is None else query.where(PeerTag.client_id.in_(chunk)))
+        for id, tag in rows:
+            tags.setdefault(id, []).append(tag)
+    return tags
+
+def tag_list(tags) -> list:
+    """Tags as sent by a client: a list of strings, or a lone string for a single tag"""
+    if isinstance(tags, str):
+        return [tags]
+    if not isinstance(tags, list):
+        return []
+    return [tag for tag in tags if isinstance(tag, str)]
+
+async def set_peer_tags(db: AsyncSession, tags: dict):
+    """Replace the tags of each client in {id: [tag, ...]}"""
+    if not tags:
+        return
+    ids = list(tags)
+    for start in range(0, len(ids), BULK_LOOKUP_CHUNK):
+        await db.execute(delete(PeerTag).where(PeerTag.client_id.in_(ids[start:start + BULK_LOOKUP_CHUNK])))
+    rows = [{"client_id": id, "tag": tag} for id, client_tags in tags.items()
+            for tag in dict.fromkeys(tag_list(client_tags)) if tag]
+    if rows:
+        await db.execute(insert(PeerTag.__table__), rows)
+
+async def write_peer_status(rows: List[dict]) -> int:
+    """Upsert buffered presence of known peers in one batch and return how many were written
+
+    Devices report without logging in, so nothing they send touches the
+    address book revision or change log: reports cannot invalidate ETags
+    or flood /api/ab/changes. Clients see new presence on their next full fetch.
+    """
+    ids = [r["client_id"] for r in rows]
+    async with AsyncSessionLocal() as db:
+        known = set()
+        for i in range(0, len(ids), BULK_LOOKUP_CHUNK):
+            known.update((await db.execute(
+                select(ClientID.client_id).where(ClientID.client_id.in_(ids[i:i + BULK_LOOKUP_CHUNK]))
+            )).scalars().all())
+        # Ignore ids that are in no address book
+        rows = [r for r in rows if r["client_id"] in known]
+        if not rows:
+            return 0
+        table = PeerStatus.__table__
+        stmt = dialect_insert(table)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.client_id],
+            set_={"last_seen": stmt.excluded.last_seen, **{
+                f: func.coalesce(stmt.excluded[f], table.c[f]) for f in SYSINFO_FIELDS
+            }}
+        ), rows)
+        await db.commit()
+    return len(rows)
+
+# Columns a peer list needs, selected as plain rows instead of ClientID entities
+PEER_COLUMNS = (ClientID.id, ClientID.client_id, ClientID.alias, ClientID.notes)
+
+def format_peer(peer, tags: List[str]) -> dict:
+    """Peer entry in the RustDesk address book format, from a PEER_COLUMNS row with_peer_status"""
+    return {
+        "id": peer.client_id,
+        "alias": peer.alias or peer.client_id,
+        "tags": tags,
+        "note": peer.notes or "",
+        "username": peer.username or "",
+        "hostname": peer.hostname or "",
+        "platform": peer.platform or ""
+    }
+
+def with_peer_status(query):
+    """Add the SYSINFO_FIELDS of each client to a select over client_ids"""
+    return query.outerjoin(PeerStatus, PeerStatus.client_id == ClientID.client_id).add_columns(
+        *(getattr(PeerStatus, f) for f in SYSINFO_FIELDS)
+    )
+
+def json_response(content, response: Optional[Response] = None) -> ORJSONResponse:
+    """Serialize a large body of plain dicts with orjson, skipping FastAPI's jsonable_encoder pass
+
+    Headers set on the endpoint's injected response (e.g. the ETag) are carried over.
+    """
+    return ORJSONResponse(content, headers=dict(response.headers) if response is not None else None)
+
+def not_modified(request: Request, response: Response, revision: int) -> bool:
+    """Set the ETag for revision, True when the client already has it"""
+    etag = f'"ab-{revision}"'
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in [t.strip() for t in if_none_match.split(",")]
+
+def not_modified_response(response: Response) -> Response:
+    return Response(status_code=304, headers=dict(response.headers))
+
+async def delete_clients(clients: List[ClientID], db: AsyncSession):
+    """Delete clients and their grants with set-based statements and commit"""
+    ids = [c.id for c in clients]
+    # Tombstones for everyone who could see them: admins via the shared row, grantees individually
+    grantees = (await db.execute(
+        select(ClientID.client_id, EffectivePermission.user_id).join(
+            EffectivePermission, EffectivePermission.client_id == ClientID.id
+        ).where(ClientID.id.in_(ids))
+    )).all()
+    await db.execute(delete(UserClientPermission).where(UserClientPermission.client_id.in_(ids)))
+    await db.execute(delete(EffectivePermission).where(EffectivePermission.client_id.in_(ids)))
+    await db.execute(delete(ClientGroupMember).where(ClientGroupMember.client_id.in_(ids)))
+    await db.execute(delete(PeerTag).where(PeerTag.client_id.in_(ids)))
+    await db.execute(delete(PeerStatus).where(PeerStatus.client_id.in_([c.client_id for c in clients])))
+    await db.execute(delete(ClientID).where(ClientID.id.in_(ids)))
+    await log_ab_changes(db, [(c.client_id, ALL_USERS) for c in clients] + [tuple(g) for g in grantees], deleted=True)
+    await db.commit()
+    for client in clients:
+        forget_client(client.client_id)
+
 # API Routes
 
 @app.post("/api/login")
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
+async def login(user_data: UserLogin, db: AsyncSession = Depends(get_db)):
     """User login endpoint"""
-    user = db.query(User).filter(User.username == user_data.username).first()
-    if not user or not verify_password(user_data.password, user.password_hash):
+    user = (await db.execute(select(User).where(User.username == user_data.username))).scalars().first()
+    if not user or not await verify_password_async(user_data.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
-    access_token = create_access_token(data={"sub": user.username})
+    session = AuthSession(
+        jti=uuid.uuid4().hex,
+        user_id=user.id,
+        expires_at=datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    db.add(session)
+    await db.commit()
+    access_token = create_access_token(data={"sub": user.username, "jti": session.jti}, expire=session.expires_at)
     return {
         "access_token": access_token,
         "type": "account",
@@ -211,7 +1592,7 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
     }
 
 @app.get("/api/currentUser")
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: AuthUser = Depends(get_current_user)):
     """Get current user information"""
     return {
         "name": current_user.username,
@@ -220,72 +1601,232 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
     }
 
 @app.post("/api/logout")
-async def logout(current_user: User = Depends(get_current_user)):
-    """User logout (stateless, just returns success)"""
+async def logout(
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """User logout, revokes the token it was called with"""
+    if current_user.jti:
+        rows = await revoke_sessions(db, AuthSession.jti == current_user.jti)
+        await db.commit()
+        sessions_revoked(rows)
     return {"message": "Logged out successfully"}
 
+# Device presence, reported by RustDesk clients without logging in
+
+def reported_id(info: dict) -> str:
+    return str(info.get("id") or "").replace(" ", "")
+
+def reported_field(info: dict, *keys) -> Optional[str]:
+    """First non-empty of keys in a device report, cut to the column size"""
+    for key in keys:
+        if info.get(key):
+            return str(info[key])[:255]
+    return None
+
+@app.post("/api/heartbeat")
+async def heartbeat(info: dict):
+    """Mark a device as seen, written to peer_status with the next batch"""
+    client_id = reported_id(info)
+    if client_id:
+        presence.record(client_id)
+    return {}
+
+@app.post("/api/sysinfo")
+async def sysinfo(info: dict):
+    """Record a device's host name, user and platform, written with the next batch"""
+    client_id = reported_id(info)
+    if not client_id:
+        return PlainTextResponse("ID_NOT_FOUND")
+    presence.record(
+        client_id,
+        hostname=reported_field(info, "hostname"),
+        username=reported_field(info, "username"),
+        platform=reported_field(info, "platform", "os")
+    )
+    return PlainTextResponse("SYSINFO_UPDATED")
+
 # Address Book Endpoints (RustDesk compatible)
 
 @app.get("/api/ab/list")
-async def list_address_books(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def list_address_books(
+    request: Request,
+    response: Response,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
     """List address books - returns a default address book"""
+    if not_modified(request, response, await read_ab_revision(db)):
+        return not_modified_response(response)
+    
     return [{
         "guid": "default",
         "name": "My address book",
         "share_rule": 0  # 0 = read, 1 = write
     }]
 
-@app.post("/api/ab/peers")
+@app.api_route("/api/ab/peers", methods=["GET", "POST"])
 async def get_peers(
+    request: Request,
+    response: Response,
     current: int = 1,
     pageSize: int = 100,
     ab: str = "default",
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    tag: Optional[str] = None,
+    id: Optional[str] = None,
+    alias: Optional[str] = None,
+    note: Optional[str] = None,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """Get peers (client IDs) that the user has access to"""
-    # Get all client IDs user has read access to
-    if current_user.role == "admin":
-        clients = db.query(ClientID).all()
+    """Get peers (client IDs) that the user has access to
+
+    Passing `cursor` (empty for the first page) switches to keyset pagination:
+    the response carries a `next` cursor instead of `total`, and each page
+    costs the same regardless of how deep into the book it is. An admin paging
+    the whole book gets peers in client ID order, other users and tag filters
+    in the order the peers were added.
+
+    Passing `tag` only returns peers carrying that tag, `id`, `alias` and
+    `note` only those containing the given text (case-insensitive).
+
+    Responses carry the address book revision as an ETag, a matching
+    If-None-Match gets a 304 without touching the peer tables.
+    """
+    if not_modified(request, response, await read_ab_revision(db)):
+        return not_modified_response(response)
+    
+    # Get client IDs user has read access to
+    query = select(*PEER_COLUMNS)
+    order_by = ClientID.id
+    if current_user.role != "admin":
+        # Join to the clients user has access to, driven by the effective_permissions
+        # primary key. Ordering by the permission side lets the page walk it in order.
+        query = query.join(
+            EffectivePermission, EffectivePermission.client_id == ClientID.id
+        ).where(EffectivePermission.user_id == current_user.id)
+        order_by = EffectivePermission.client_id
+    if tag:
+        # Served by ix_peer_tags_tag, which also yields the clients in id order
+        query = query.join(PeerTag, PeerTag.client_id == ClientID.id).where(PeerTag.tag == tag)
+    for column, term in (("client_id", id), ("alias", alias), ("notes", note)):
+        # RustDesk clients wrap terms in % wildcards, the match is a substring one anyway
+        term = (term or "").strip("%")
+        if term:
+            query = query.where(peer_search_filter(column, term, await has_peer_search_fts(db)))
+    
+    pageSize = max(pageSize, 1)
+    if cursor is not None:
+        # Keyset pagination, seek past the last (client_id, id) seen. The whole book
+        # pages in client_id order on its unique index. Filtered by grants or tag it
+        # pages in id order along the driving index (the effective_permissions
+        # (user_id, client_id) primary key or ix_peer_tags_tag), so a page reads
+        # pageSize rows of it rather than sorting every match.
+        by_id = current_user.role != "admin" or bool(tag)
+        if tag and current_user.role == "admin":
+            order_by = PeerTag.client_id
+        if cursor:
+            last = decode_cursor(cursor)
+            if last is None:
+                return {"error": "Invalid cursor"}
+            if by_id:
+                query = query.where(order_by > last[1])
+            else:
+                query = query.where(or_(
+                    ClientID.client_id > last[0],
+                    and_(ClientID.client_id == last[0], ClientID.id > last[1])
+                ))
+        keyset = (order_by,) if by_id else (ClientID.client_id, ClientID.id)
+        rows = (await db.execute(
+            with_peer_status(query).order_by(*keyset).limit(pageSize + 1)
+        )).all()
+        has_more = len(rows) > pageSize
+        rows = rows[:pageSize]
     else:
-        # Get clients user has permission for
-        permissions = db.query(UserClientPermission).filter(
-            UserClientPermission.user_id == current_user.id
-        ).all()
-        client_ids = [p.client_id for p in permissions]
-        clients = db.query(ClientID).filter(ClientID.id.in_(client_ids)).all()
-    
-    # Pagination
-    total = len(clients)
-    start = (current - 1) * pageSize
-    end = start + pageSize
-    clients_page = clients[start:end]
+        # Pagination (done in SQL so only one page is ever loaded)
+        current = max(current, 1)
+        total = (await db.execute(query.with_only_columns(func.count(ClientID.id)))).scalar()
+        rows = (await db.execute(
+            with_peer_status(query).order_by(order_by).offset((current - 1) * pageSize).limit(pageSize)
+        )).all()
     
     # Format response
-    peers = []
-    for client in clients_page:
-        tags = json.loads(client.tags) if client.tags else []
-        peers.append({
-            "id": client.client_id,
-            "alias": client.alias or client.client_id,
-            "tags": tags,
-            "note": client.notes or "",
-            "username": "",  # Can be populated from recent sessions
-            "hostname": "",  # Can be populated from recent sessions
-            "platform": ""   # Can be populated from recent sessions
-        })
+    tags = await load_peer_tags(db, [row.id for row in rows])
+    peers = [format_peer(row, tags.get(row.id, [])) for row in rows]
     
-    return {
+    if cursor is not None:
+        return json_response({
+            "data": peers,
+            "next": encode_cursor(rows[-1].client_id, rows[-1].id) if has_more else None
+        }, response)
+    
+    return json_response({
         "total": total,
         "data": peers
-    }
+    }, response)
+
+@app.get("/api/ab/changes")
+async def get_changes(
+    since: int = 0,
+    ab: str = "default",
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Peers changed since revision `since`, for incremental sync
+
+    Returns the current `revision` to pass as `since` next time, the peers
+    added or updated (`upserts`) and the IDs of peers deleted or no longer
+    visible (`deletes`). When `reset` is true the change log cannot cover the
+    gap and the client must refetch /api/ab/peers in full.
+    """
+    state = (await db.execute(
+        select(AddressBookRevision.revision, AddressBookRevision.compacted_revision).where(AddressBookRevision.guid == ab)
+    )).first()
+    revision, compacted = state if state else (0, 0)
+    if since > revision:
+        return {"error": "Unknown revision"}
+    
+    in_range = and_(AddressBookChange.revision > since, AddressBookChange.revision <= revision)
+    mine = or_(AddressBookChange.user_id == ALL_USERS, AddressBookChange.user_id == current_user.id)
+    reset = since < compacted or (await db.execute(select(exists().where(
+        in_range, AddressBookChange.user_id == current_user.id, AddressBookChange.client_id.is_(None)
+    )))).scalar()
+    if reset:
+        return {"revision": revision, "reset": True, "upserts": [], "deletes": []}
+    
+    changed = select(AddressBookChange.client_id).where(in_range, mine, AddressBookChange.client_id.is_not(None))
+    visible = select(*PEER_COLUMNS).where(ClientID.client_id.in_(changed))
+    if current_user.role != "admin":
+        visible = visible.join(
+            EffectivePermission, EffectivePermission.client_id == ClientID.id
+        ).where(EffectivePermission.user_id == current_user.id)
+    upserts = (await db.execute(with_peer_status(visible).order_by(ClientID.client_id))).all()
+    
+    # A changed peer that is no longer visible is a delete, but only report it to users
+    # who could have had it: admins through the shared row, others through their own row
+    tombstone_rows = select(AddressBookChange.client_id).where(
+        in_range,
+        AddressBookChange.user_id == (ALL_USERS if current_user.role == "admin" else current_user.id),
+        AddressBookChange.client_id.is_not(None)
+    )
+    visible_ids = {c.client_id for c in upserts}
+    deletes = sorted({c for c in (await db.execute(tombstone_rows)).scalars().all() if c not in visible_ids})
+    tags = await load_peer_tags(db, [c.id for c in upserts])
+    
+    return json_response({
+        "revision": revision,
+        "reset": False,
+        "upserts": [format_peer(c, tags.get(c.id, [])) for c in upserts],
+        "deletes": deletes
+    })
 
 @app.post("/api/ab/peer/add/{ab_guid}")
 async def add_peer(
     ab_guid: str,
     peer: dict,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
 ):
     """Add a peer to address book"""
     client_id_str = peer.get("id", "").replace(" ", "")
@@ -293,36 +1834,36 @@ async def add_peer(
         return {"error": "Client ID is required"}
     
     # Check if client exists
-    existing = db.query(ClientID).filter(ClientID.client_id == client_id_str).first()
+    existing, permission_type = (await get_clients_for_user(current_user, [client_id_str], db)).get(client_id_str, (None, None))
     
     if existing:
         # Check if user has write permission
-        if not check_permission(current_user, existing, "write", db):
+        if not check_permission(current_user, permission_type, "write"):
             return {"error": "Permission denied"}
         
-        # Update existing
+        # Update existing, hashing first so bcrypt runs before this transaction's turn to write
+        if "password" in peer and peer["password"]:
+            existing.password_hash = await get_password_hash_async(peer["password"])
         if "alias" in peer:
             existing.alias = peer["alias"]
         if "tags" in peer:
-            existing.tags = json.dumps(peer["tags"])
+            await set_peer_tags(db, {existing.id: peer["tags"]})
         if "note" in peer:
             existing.notes = peer["note"]
-        if "password" in peer and peer["password"]:
-            existing.password_hash = get_password_hash(peer["password"])
     else:
         # Create new client
         new_client = ClientID(
             client_id=client_id_str,
             alias=peer.get("alias"),
-            tags=json.dumps(peer.get("tags", [])),
             notes=peer.get("note"),
             created_by=current_user.id
         )
         if "password" in peer and peer["password"]:
-            new_client.password_hash = get_password_hash(peer["password"])
+            new_client.password_hash = await get_password_hash_async(peer["password"])
         
         db.add(new_client)
-        db.flush()
+        await db.flush()
+        await set_peer_tags(db, {new_client.id: peer.get("tags")})
         
         # Grant admin permission to creator
         permission = UserClientPermission(
@@ -332,85 +1873,230 @@ async def add_peer(
             granted_by=current_user.id
         )
         db.add(permission)
+        await db.flush()
+        await refresh_effective_permissions(db, [current_user.id], [new_client.id])
     
-    db.commit()
+    await log_ab_changes(db, [(client_id_str, ALL_USERS)])
+    await db.commit()
     return {"message": "Success"}
 
 @app.put("/api/ab/peer/update/{ab_guid}")
 async def update_peer(
     ab_guid: str,
     peer: dict,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
 ):
     """Update a peer in address book"""
     client_id_str = peer.get("id", "").replace(" ", "")
     if not client_id_str:
         return {"error": "Client ID is required"}
     
-    client = db.query(ClientID).filter(ClientID.client_id == client_id_str).first()
+    client, permission_type = (await get_clients_for_user(current_user, [client_id_str], db)).get(client_id_str, (None, None))
     if not client:
         return {"error": "Client not found"}
     
-    if not check_permission(current_user, client, "write", db):
+    if not check_permission(current_user, permission_type, "write"):
         return {"error": "Permission denied"}
     
     if "alias" in peer:
         client.alias = peer["alias"]
     if "tags" in peer:
-        client.tags = json.dumps(peer["tags"])
+        await set_peer_tags(db, {client.id: peer["tags"]})
     if "note" in peer:
         client.notes = peer["note"]
     
-    db.commit()
+    await log_ab_changes(db, [(client_id_str, ALL_USERS)])
+    await db.commit()
     return {"message": "Success"}
 
 @app.delete("/api/ab/peer/delete/{ab_guid}/{client_id}")
 async def delete_peer(
     ab_guid: str,
     client_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
 ):
     """Delete a peer from address book"""
     client_id_str = client_id.replace(" ", "")
-    client = db.query(ClientID).filter(ClientID.client_id == client_id_str).first()
+    client, permission_type = (await get_clients_for_user(current_user, [client_id_str], db)).get(client_id_str, (None, None))
     if not client:
         return {"error": "Client not found"}
     
-    if not check_permission(current_user, client, "admin", db):
+    if not check_permission(current_user, permission_type, "admin"):
         return {"error": "Permission denied"}
     
-    db.delete(client)
-    db.commit()
+    await delete_clients([client], db)
     return {"message": "Success"}
 
+@app.delete("/api/ab/peer/{ab_guid}")
+async def delete_peers(
+    ab_guid: str,
+    peer_ids: List[str],
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Delete several peers from address book, nothing is deleted if any one fails"""
+    client_id_strs = [p.replace(" ", "") for p in peer_ids]
+    found = await get_clients_for_user(current_user, client_id_strs, db)
+    
+    missing = [c for c in client_id_strs if c not in found]
+    if missing:
+        return {"error": f"Client not found: {', '.join(missing)}"}
+    denied = [c for c, (_, permission_type) in found.items() if not check_permission(current_user, permission_type, "admin")]
+    if denied:
+        return {"error": f"Permission denied: {', '.join(denied)}"}
+    
+    await delete_clients([client for client, _ in found.values()], db)
+    return {"message": "Success"}
+
+@app.post("/api/ab/peer/bulk/{ab_guid}")
+async def bulk_add_peers(
+    ab_guid: str,
+    peers: List[dict],
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Add or update many peers in one transaction
+
+    New peers go in with one INSERT ... ON CONFLICT DO NOTHING, whose returned
+    rows are the peers this request created; the rest are updated with one
+    INSERT ... ON CONFLICT DO UPDATE. Fields left out (or null) keep their
+    current value on existing peers. Returns one result per input peer, in order.
+    """
+    if len(peers) > BULK_MAX_PEERS:
+        return {"error": f"At most {BULK_MAX_PEERS} peers per request"}
+    
+    results = [None] * len(peers)
+    rows = {}  # client_id -> (index, values), a later duplicate replaces an earlier one
+    tags = {}  # client_id -> tags, for peers that set them
+    for i, peer in enumerate(peers):
+        client_id_str = str(peer.get("id") or "").replace(" ", "")
+        if not client_id_str:
+            results[i] = {"id": peer.get("id"), "result": "error", "error": "Client ID is required"}
+            continue
+        if client_id_str in rows:
+            results[rows[client_id_str][0]] = {"id": client_id_str, "result": "error", "error": "Duplicate client ID"}
+            tags.pop(client_id_str, None)
+        if peer.get("tags") is not None:
+            tags[client_id_str] = peer["tags"]
+        rows[client_id_str] = (i, {
+            "client_id": client_id_str,
+            "alias": peer.get("alias"),
+            "notes": peer.get("note"),
+            "password": peer.get("password"),
+            "created_by": current_user.id
+        })
+    
+    # Existing clients need write permission, everything else is inserted
+    existing = {}
+    client_ids = list(rows)
+    for start in range(0, len(client_ids), BULK_LOOKUP_CHUNK):
+        existing.update(await get_clients_for_user(current_user, client_ids[start:start + BULK_LOOKUP_CHUNK], db))
+    for client_id_str, (_, permission_type) in existing.items():
+        if not check_permission(current_user, permission_type, "write"):
+            i, _ = rows.pop(client_id_str)
+            results[i] = {"id": client_id_str, "result": "error", "error": "Permission denied"}
+    
+    values = [v for _, v in rows.values()]
+    with_password = [v for v in values if v["password"]]
+    # Hash in small jobs, one after another, before anything is written
+    hashes = []
+    for start in range(0, len(with_password), BULK_HASH_CHUNK):
+        chunk = with_password[start:start + BULK_HASH_CHUNK]
+        hashes += await password_pool.run(get_password_hashes, [v["password"] for v in chunk])
+    for v in values:
+        v["password_hash"] = None
+    for v, password_hash in zip(with_password, hashes):
+        v["password_hash"] = password_hash
+    for v in values:
+        del v["password"]
+    
+    # The insert decides what was created, a peer that appeared since the lookup above is not
+    created = {}
+    updated = {}
+    clients = ClientID.__table__
+    if values:
+        created = {client_id: id for id, client_id in (await db.execute(
+            dialect_insert(clients).on_conflict_do_nothing(
+                index_elements=[clients.c.client_id]
+            ).returning(clients.c.id, clients.c.client_id),
+            values
+        )).all()}
+    conflicting = [v for v in values if v["client_id"] not in created]
+    if conflicting:
+        stmt = dialect_insert(clients)
+        update_where = None
+        if current_user.role != "admin":
+            # Re-check write access inside the statement in case a peer appeared meanwhile.
+            # ON CONFLICT clauses are not correlated, so name the conflicting row directly.
+            update_where = exists().where(
+                EffectivePermission.client_id == literal_column(f"{clients.name}.id"),
+                EffectivePermission.user_id == current_user.id,
+                or_(EffectivePermission.permission_type == "write", EffectivePermission.permission_type == "admin")
+            )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[clients.c.client_id],
+            set_={col: func.coalesce(stmt.excluded[col], clients.c[col])
+                  for col in ("alias", "notes", "password_hash")},
+            where=update_where
+        ).returning(clients.c.id, clients.c.client_id)
+        updated = {client_id: id for id, client_id in (await db.execute(stmt, conflicting)).all()}
+    returned = {**created, **updated}
+    
+    # Creator gets admin on every peer they created, as in add_peer
+    if created:
+        await db.execute(
+            dialect_insert(UserClientPermission.__table__).on_conflict_do_nothing(index_elements=["user_id", "client_id"]),
+            [{"user_id": current_user.id, "client_id": id, "permission_type": "admin", "granted_by": current_user.id}
+             for id in created.values()]
+        )
+        await refresh_effective_permissions(db, [current_user.id], list(created.values()))
+    await set_peer_tags(db, {id: tags[client_id] for client_id, id in returned.items() if client_id in tags})
+    if returned:
+        await log_ab_changes(db, [(client_id, ALL_USERS) for client_id in returned])
+    await db.commit()
+    invalidate("permissions", current_user.id)
+    
+    for client_id_str, (i, _) in rows.items():
+        if client_id_str not in returned:
+            results[i] = {"id": client_id_str, "result": "error", "error": "Permission denied"}
+        else:
+            results[i] = {"id": client_id_str, "result": "created" if client_id_str in created else "updated"}
+    
+    return {
+        "created": sum(1 for r in results if r["result"] == "created"),
+        "updated": sum(1 for r in results if r["result"] == "updated"),
+        "failed": sum(1 for r in results if r["result"] == "error"),
+        "data": results
+    }
+
 # Admin Endpoints
 
 @app.post("/api/admin/users", dependencies=[Depends(get_current_user)])
 async def create_user(
     user_data: UserCreate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
 ):
     """Create a new user (admin only)"""
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Check if user exists
-    existing = db.query(User).filter(User.username == user_data.username).first()
+    existing = (await db.execute(select(User).where(User.username == user_data.username))).scalars().first()
     if existing:
         raise HTTPException(status_code=400, detail="Username already exists")
     
     new_user = User(
         username=user_data.username,
-        password_hash=get_password_hash(user_data.password),
+        password_hash=await get_password_hash_async(user_data.password),
         email=user_data.email,
         role=user_data.role
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     
     return {
         "id": new_user.id,
@@ -421,57 +2107,262 @@ async def create_user(
 
 @app.get("/api/admin/users", dependencies=[Depends(get_current_user)])
 async def list_users(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """List all users (admin only)"""
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    users = db.query(User).all()
-    return [{
+    users = (await db.execute(select(User.id, User.username, User.email, User.role, User.created_at))).all()
+    return json_response([{
         "id": u.id,
         "username": u.username,
         "email": u.email,
         "role": u.role,
         "created_at": u.created_at.isoformat() if u.created_at else None
-    } for u in users]
+    } for u in users])
+
+@app.put("/api/admin/users/{user_id}", dependencies=[Depends(get_current_user)])
+async def update_user(
+    user_id: int,
+    user_data: UserUpdate,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Update a user's email, role or password (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    user = await db.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Hash before anything is written, so bcrypt runs outside the write queue
+    if user_data.password:
+        user.password_hash = await get_password_hash_async(user_data.password)
+    if user_data.email is not None:
+        user.email = user_data.email
+    if user_data.role is not None and user_data.role != user.role:
+        user.role = user_data.role
+        # Admins see every peer, so a role change alters the whole peer list
+        await log_ab_changes(db, [(None, user.id)])
+    await db.commit()
+    invalidate_user(user.id)
+    
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "role": user.role
+    }
+
+@app.delete("/api/admin/users/{user_id}", dependencies=[Depends(get_current_user)])
+async def delete_user(
+    user_id: int,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Delete a user and their permissions (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if user_id == current_user.id:
+        raise HTTPException(status_code=400, detail="Cannot delete yourself")
+    
+    user = await db.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Keep the clients and grants they created, just forget who did it
+    await db.execute(delete(UserClientPermission).where(UserClientPermission.user_id == user_id))
+    await db.execute(delete(EffectivePermission).where(EffectivePermission.user_id == user_id))
+    await db.execute(delete(UserGroupMember).where(UserGroupMember.user_id == user_id))
+    await db.execute(update(UserClientPermission).where(UserClientPermission.granted_by == user_id).values(granted_by=None))
+    await db.execute(update(GroupPermission).where(GroupPermission.granted_by == user_id).values(granted_by=None))
+    await db.execute(update(ClientID).where(ClientID.created_by == user_id).values(created_by=None))
+    await db.execute(delete(User).where(User.id == user_id))
+    rows = await revoke_sessions(db, AuthSession.user_id == user_id)
+    await db.commit()
+    invalidate_user(user_id)
+    sessions_revoked(rows)
+    return {"message": "User deleted"}
+
+@app.get("/api/admin/users/{user_id}/sessions", dependencies=[Depends(get_current_user)])
+async def list_user_sessions(
+    user_id: int,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """List a user's unexpired sessions, newest first (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    rows = (await db.execute(
+        select(AuthSession.jti, AuthSession.created_at, AuthSession.expires_at, AuthSession.revoked_at).where(
+            AuthSession.user_id == user_id,
+            AuthSession.expires_at > datetime.utcnow()
+        ).order_by(AuthSession.created_at.desc())
+    )).all()
+    return [{
+        "jti": jti,
+        "created_at": created_at.isoformat(),
+        "expires_at": expires_at.isoformat(),
+        "revoked_at": revoked_at.isoformat() if revoked_at else None
+    } for jti, created_at, expires_at, revoked_at in rows]
+
+@app.post("/api/admin/users/{user_id}/sessions/revoke", dependencies=[Depends(get_current_user)])
+async def revoke_user_sessions(
+    user_id: int,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Revoke every live session of a user, logging them out everywhere (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    rows = await revoke_sessions(db, AuthSession.user_id == user_id)
+    await db.commit()
+    sessions_revoked(rows)
+    return {"revoked": len(rows)}
+
+@app.post("/api/admin/sessions/{jti}/revoke", dependencies=[Depends(get_current_user)])
+async def revoke_session(
+    jti: str,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Revoke one session by its jti (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    rows = await revoke_sessions(db, AuthSession.jti == jti)
+    if not rows:
+        raise HTTPException(status_code=404, detail="Session not found or already ended")
+    await db.commit()
+    sessions_revoked(rows)
+    return {"message": "Session revoked"}
+
+@app.get("/api/admin/stats", dependencies=[Depends(get_current_user)])
+async def get_stats(current_user: AuthUser = Depends(get_current_user)):
+    """Cache counters and password pool queue depth (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "auth_cache": auth_cache.stats(),
+        "permission_cache": permission_cache.stats(),
+        "password_pool": password_pool.stats(),
+        "write_queue": write_queue.stats(),
+        "read_routing": dict(read_routing, enabled=read_engine is not async_engine),
+        "revoked_tokens": revoked_tokens.stats(),
+        "presence": presence.stats(),
+        "cache_backend": cache_backend.stats()
+    }
 
 @app.get("/api/admin/clients", dependencies=[Depends(get_current_user)])
 async def list_all_clients(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """List all client IDs (admin only)"""
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    clients = db.query(ClientID).all()
-    return [{
+    clients = (await db.execute(
+        select(
+            ClientID.id, ClientID.client_id, ClientID.alias, ClientID.notes,
+            ClientID.created_by, ClientID.created_at, PeerStatus.last_seen
+        ).outerjoin(PeerStatus, PeerStatus.client_id == ClientID.client_id)
+    )).all()
+    tags = await load_peer_tags(db)
+    return json_response([{
         "id": c.id,
         "client_id": c.client_id,
         "alias": c.alias,
-        "tags": json.loads(c.tags) if c.tags else [],
+        "tags": tags.get(c.id, []),
         "notes": c.notes,
         "created_by": c.created_by,
-        "created_at": c.created_at.isoformat() if c.created_at else None
-    } for c in clients]
+        "created_at": c.created_at.isoformat() if c.created_at else None,
+        "last_seen": c.last_seen.isoformat() if c.last_seen else None
+    } for c in clients])
+
+EXPORT_FIELDS = ["id", "alias", "note", "tags", "created_by", "created_at"]
+
+async def export_peers(format: str):
+    """Yield every client as NDJSON lines or CSV rows, one cursor batch at a time
+
+    Uses its own session since the response body outlives the request's.
+    Rows carry the same id/alias/note/tags fields the bulk endpoint and
+    `ab.py bulk-add` accept, so an export can be imported again as is.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    if format == "csv":
+        writer.writeheader()
+    async with AsyncSessionLocal() as db:
+        # Plain column rows rather than entities, so nothing builds up in the identity map
+        result = await db.stream(
+            select(
+                ClientID.id, ClientID.client_id, ClientID.alias, ClientID.notes,
+                ClientID.created_by, ClientID.created_at
+            ).order_by(ClientID.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for clients in result.partitions():
+            tags = await load_peer_tags(db, [c.id for c in clients])
+            for c in clients:
+                row = {
+                    "id": c.client_id,
+                    "alias": c.alias,
+                    "note": c.notes,
+                    "tags": tags.get(c.id, []),
+                    "created_by": c.created_by,
+                    "created_at": c.created_at.isoformat() if c.created_at else None
+                }
+                if format == "csv":
+                    # A JSON array, since tags may themselves contain commas
+                    row["tags"] = json.dumps(row["tags"])
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(row) + "\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@app.get("/api/admin/export", dependencies=[Depends(get_current_user)])
+async def export_clients(
+    format: str = "ndjson",
+    current_user: AuthUser = Depends(get_current_user)
+):
+    """Stream every client as NDJSON or CSV in constant memory (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
+    
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_peers(format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="multidesk-clients.{format}"'}
+    )
 
 @app.post("/api/admin/permissions/grant", dependencies=[Depends(get_current_user)])
 async def grant_permission(
     perm: PermissionGrant,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
 ):
     """Grant permission to user for client (admin only)"""
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Check if permission exists
-    existing = db.query(UserClientPermission).filter(
+    existing = (await db.execute(select(UserClientPermission).where(
         UserClientPermission.user_id == perm.user_id,
         UserClientPermission.client_id == perm.client_id
-    ).first()
+    ))).scalars().first()
     
     if existing:
         existing.permission_type = perm.permission_type
@@ -484,31 +2375,353 @@ async def grant_permission(
             granted_by=current_user.id
         )
         db.add(new_perm)
+    await db.flush()
+    await refresh_effective_permissions(db, [perm.user_id], [perm.client_id])
     
-    db.commit()
+    client_id_str = (await db.execute(select(ClientID.client_id).where(ClientID.id == perm.client_id))).scalar()
+    await log_ab_changes(db, [(client_id_str, perm.user_id)] if client_id_str else [])
+    await db.commit()
+    invalidate("permissions", perm.user_id)
     return {"message": "Permission granted"}
 
+def permission_selector(client_ids: Optional[List[int]], tag: Optional[str]):
+    """SELECT of the client primary keys picked by a bulk grant/revoke, None if it picks nothing"""
+    if client_ids is None and not tag:
+        return None
+    if client_ids is not None and len(client_ids) > BULK_MAX_PEERS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_PEERS} client IDs per request")
+    selector = select(ClientID.id, ClientID.client_id)
+    if client_ids is not None:
+        selector = selector.where(ClientID.id.in_(client_ids))
+    if tag:
+        selector = selector.join(PeerTag, PeerTag.client_id == ClientID.id).where(PeerTag.tag == tag)
+    return selector
+
+@app.post("/api/admin/permissions/bulk-grant", dependencies=[Depends(get_current_user)])
+async def bulk_grant_permissions(
+    grant: BulkPermissionGrant,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Grant a user permission on a list of clients and/or a tag (admin only)
+
+    Applied as one INSERT ... SELECT ... ON CONFLICT DO UPDATE, existing grants
+    on the selected clients take the new permission type.
+    """
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    selector = permission_selector(grant.client_ids, grant.tag)
+    if selector is None:
+        raise HTTPException(status_code=400, detail="client_ids or tag is required")
+    if not await db.get(User, grant.user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    targets = (await db.execute(selector)).all()
+    if targets:
+        permissions = UserClientPermission.__table__
+        stmt = dialect_insert(permissions).from_select(
+            ["user_id", "client_id", "permission_type", "granted_by"],
+            selector.with_only_columns(
+                literal(grant.user_id), ClientID.id, literal(grant.permission_type), literal(current_user.id)
+            )
+        )
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[permissions.c.user_id, permissions.c.client_id],
+            set_={"permission_type": stmt.excluded.permission_type, "granted_by": stmt.excluded.granted_by}
+        ))
+        await refresh_effective_permissions(db, [grant.user_id], selector.with_only_columns(ClientID.id))
+        await log_ab_changes(db, [(client_id, grant.user_id) for _, client_id in targets])
+        await db.commit()
+        invalidate("permissions", grant.user_id)
+    return {"message": "Permissions granted", "count": len(targets)}
+
+@app.post("/api/admin/permissions/bulk-revoke", dependencies=[Depends(get_current_user)])
+async def bulk_revoke_permissions(
+    revoke: BulkPermissionRevoke,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Revoke a user's grants on a list of clients and/or a tag with one DELETE (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    selector = permission_selector(revoke.client_ids, revoke.tag)
+    if selector is None:
+        raise HTTPException(status_code=400, detail="client_ids or tag is required")
+    
+    granted = selector.join(
+        UserClientPermission, UserClientPermission.client_id == ClientID.id
+    ).where(UserClientPermission.user_id == revoke.user_id)
+    targets = (await db.execute(granted)).all()
+    if targets:
+        await db.execute(delete(UserClientPermission).where(
+            UserClientPermission.user_id == revoke.user_id,
+            UserClientPermission.client_id.in_(selector.with_only_columns(ClientID.id))
+        ))
+        # Access the user still has through a group survives the revoke
+        await refresh_effective_permissions(db, [revoke.user_id], selector.with_only_columns(ClientID.id))
+        await log_ab_changes(db, [(client_id, revoke.user_id) for _, client_id in targets], deleted=True)
+        await db.commit()
+        invalidate("permissions", revoke.user_id)
+    return {"message": "Permissions revoked", "count": len(targets)}
+
+# Group kind in the URL -> (group model, member model, member column, member entity)
+GROUP_KINDS = {
+    "users": (UserGroup, UserGroupMember, "user_id", User),
+    "clients": (ClientGroup, ClientGroupMember, "client_id", ClientID),
+}
+
+def group_kind(kind: str) -> tuple:
+    if kind not in GROUP_KINDS:
+        raise HTTPException(status_code=404, detail="Unknown group kind, use users or clients")
+    return GROUP_KINDS[kind]
+
+def users_granted_on(client_group_ids):
+    """SELECT of users whose user groups are granted on any of the client groups"""
+    return select(UserGroupMember.user_id).join(
+        GroupPermission, GroupPermission.user_group_id == UserGroupMember.group_id
+    ).where(GroupPermission.client_group_id.in_(client_group_ids)).distinct()
+
+async def group_access_changed(db: AsyncSession, user_ids: List[int]):
+    """Tell affected users to resync and forget cached grants after a group change"""
+    await log_ab_changes(db, [(None, user_id) for user_id in user_ids])
+    await db.commit()
+    invalidate("permissions")
+
+@app.post("/api/admin/groups/{kind}", dependencies=[Depends(get_current_user)])
+async def create_group(
+    kind: str,
+    group_data: GroupCreate,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Create a user or client group (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    Group, _, _, _ = group_kind(kind)
+    
+    if (await db.execute(select(Group.id).where(Group.name == group_data.name))).first():
+        raise HTTPException(status_code=400, detail="Group name already exists")
+    group = Group(name=group_data.name, description=group_data.description)
+    db.add(group)
+    await db.commit()
+    return {"id": group.id, "name": group.name, "description": group.description}
+
+@app.get("/api/admin/groups/{kind}", dependencies=[Depends(get_current_user)])
+async def list_groups(
+    kind: str,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """List user or client groups with their member counts (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    Group, Member, _, _ = group_kind(kind)
+    
+    groups = (await db.execute(
+        select(Group.id, Group.name, Group.description, func.count(Member.group_id)).outerjoin(
+            Member, Member.group_id == Group.id
+        ).group_by(Group.id, Group.name, Group.description).order_by(Group.name)
+    )).all()
+    return [{"id": id, "name": name, "description": description, "members": members}
+            for id, name, description, members in groups]
+
+@app.get("/api/admin/groups/{kind}/{group_id}", dependencies=[Depends(get_current_user)])
+async def get_group_members(
+    kind: str,
+    group_id: int,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """List the user or client ids in a group (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    Group, Member, member_column, _ = group_kind(kind)
+    
+    group = await db.get(Group, group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    members = (await db.execute(
+        select(getattr(Member, member_column)).where(Member.group_id == group_id).order_by(getattr(Member, member_column))
+    )).scalars().all()
+    return {"id": group.id, "name": group.name, "description": group.description, "members": members}
+
+@app.put("/api/admin/groups/{kind}/{group_id}/members", dependencies=[Depends(get_current_user)])
+async def update_group_members(
+    kind: str,
+    group_id: int,
+    members: GroupMembers,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Add and remove group members, unknown ids are ignored (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    Group, Member, member_column, Entity = group_kind(kind)
+    if not await db.get(Group, group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+    if len(members.add) + len(members.remove) > BULK_MAX_PEERS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_PEERS} members per request")
+    
+    column = getattr(Member, member_column)
+    if members.remove:
+        await db.execute(delete(Member).where(Member.group_id == group_id, column.in_(members.remove)))
+    if members.add:
+        await db.execute(dialect_insert(Member.__table__).from_select(
+            ["group_id", member_column],
+            select(literal(group_id), Entity.id).where(Entity.id.in_(members.add))
+        ).on_conflict_do_nothing())
+    
+    changed = list(set(members.add) | set(members.remove))
+    if kind == "users":
+        await refresh_effective_permissions(db, user_scope=changed)
+        affected = changed
+    else:
+        await refresh_effective_permissions(db, client_scope=changed)
+        affected = (await db.execute(users_granted_on([group_id]))).scalars().all()
+    await group_access_changed(db, affected)
+    return {"message": "Group updated"}
+
+@app.delete("/api/admin/groups/{kind}/{group_id}", dependencies=[Depends(get_current_user)])
+async def delete_group(
+    kind: str,
+    group_id: int,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Delete a group along with its members and grants (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    Group, Member, member_column, _ = group_kind(kind)
+    if not await db.get(Group, group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    # Work out who loses access before the rows that say so are gone
+    members = (await db.execute(select(getattr(Member, member_column)).where(Member.group_id == group_id))).scalars().all()
+    if kind == "users":
+        affected = members
+        grants = GroupPermission.user_group_id == group_id
+    else:
+        affected = (await db.execute(users_granted_on([group_id]))).scalars().all()
+        grants = GroupPermission.client_group_id == group_id
+    
+    await db.execute(delete(GroupPermission).where(grants))
+    await db.execute(delete(Member).where(Member.group_id == group_id))
+    await db.execute(delete(Group).where(Group.id == group_id))
+    if kind == "users":
+        await refresh_effective_permissions(db, user_scope=members)
+    else:
+        await refresh_effective_permissions(db, user_scope=affected, client_scope=members)
+    await group_access_changed(db, affected)
+    return {"message": "Group deleted"}
+
+@app.post("/api/admin/group-permissions/grant", dependencies=[Depends(get_current_user)])
+async def grant_group_permission(
+    perm: GroupPermissionGrant,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Grant every member of a user group permission on every client in a client group (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if not await db.get(UserGroup, perm.user_group_id) or not await db.get(ClientGroup, perm.client_group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    grants = GroupPermission.__table__
+    stmt = dialect_insert(grants).values(
+        user_group_id=perm.user_group_id, client_group_id=perm.client_group_id,
+        permission_type=perm.permission_type, granted_by=current_user.id
+    )
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[grants.c.user_group_id, grants.c.client_group_id],
+        set_={"permission_type": stmt.excluded.permission_type, "granted_by": stmt.excluded.granted_by}
+    ))
+    users = select(UserGroupMember.user_id).where(UserGroupMember.group_id == perm.user_group_id)
+    clients = select(ClientGroupMember.client_id).where(ClientGroupMember.group_id == perm.client_group_id)
+    await refresh_effective_permissions(db, users, clients)
+    await group_access_changed(db, (await db.execute(users)).scalars().all())
+    return {"message": "Permission granted"}
+
+@app.post("/api/admin/group-permissions/revoke", dependencies=[Depends(get_current_user)])
+async def revoke_group_permission(
+    perm: GroupPermissionRevoke,
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+):
+    """Remove a user group's grant on a client group (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    await db.execute(delete(GroupPermission).where(
+        GroupPermission.user_group_id == perm.user_group_id,
+        GroupPermission.client_group_id == perm.client_group_id
+    ))
+    users = select(UserGroupMember.user_id).where(UserGroupMember.group_id == perm.user_group_id)
+    clients = select(ClientGroupMember.client_id).where(ClientGroupMember.group_id == perm.client_group_id)
+    await refresh_effective_permissions(db, users, clients)
+    await group_access_changed(db, (await db.execute(users)).scalars().all())
+    return {"message": "Permission revoked"}
+
+@app.get("/api/admin/group-permissions", dependencies=[Depends(get_current_user)])
+async def list_group_permissions(
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """List all group grants (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    grants = (await db.execute(
+        select(
+            GroupPermission.user_group_id, GroupPermission.client_group_id,
+            GroupPermission.permission_type, GroupPermission.granted_at
+        ).order_by(GroupPermission.user_group_id, GroupPermission.client_group_id)
+    )).all()
+    return [{
+        "user_group_id": g.user_group_id,
+        "client_group_id": g.client_group_id,
+        "permission_type": g.permission_type,
+        "granted_at": g.granted_at.isoformat() if g.granted_at else None
+    } for g in grants]
+
 @app.get("/api/admin/permissions/{client_id}", dependencies=[Depends(get_current_user)])
 async def get_client_permissions(
     client_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Get all users with permissions for a client (admin only)"""
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    permissions = db.query(UserClientPermission).filter(
-        UserClientPermission.client_id == client_id
-    ).all()
+    # One joined query, no per-grant user lookups
+    permissions = (await db.execute(
+        select(
+            UserClientPermission.user_id, User.username,
+            UserClientPermission.permission_type, UserClientPermission.granted_at
+        ).join(User, User.id == UserClientPermission.user_id).where(
+            UserClientPermission.client_id == client_id
+        )
+    )).all()
     
     return [{
         "user_id": p.user_id,
-        "user": p.user.username,
+        "user": p.username,
         "permission_type": p.permission_type,
         "granted_at": p.granted_at.isoformat() if p.granted_at else None
     } for p in permissions]
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request, db: AsyncSession = Depends(get_db)):
+    """Per-route metrics for Prometheus, for METRICS_TOKEN or, without one, an admin's token"""
+    if METRICS_TOKEN:
+        if request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+            raise HTTPException(status_code=401, detail="Invalid metrics token")
+    else:
+        current_user = await get_current_user(await security(request), db)
+        if current_user.role != "admin":
+            raise HTTPException(status_code=403, detail="Admin access required")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Database migrations for the MultiDesk Address Book API
+
+Run once per deploy, before starting the server:
+
+    python migrate.py            # apply pending migrations
+    python migrate.py --status   # list applied and pending migrations
+
+Applied versions are recorded in the schema_migrations table. Migration 1
+creates any missing table from the current models, so every later migration
+has to be a no-op on a schema it already produced (check before altering).
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, insert, select, text
+
+import main
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def create_tables(conn):
+    """Create every table that does not exist yet"""
+    main.Base.metadata.create_all(bind=conn)
+
+
+def add_compacted_revision(conn):
+    """ab_revisions.compacted_revision, added with the change log"""
+    columns = {c["name"] for c in inspect(conn).get_columns("ab_revisions")}
+    if "compacted_revision" not in columns:
+        conn.execute(text("ALTER TABLE ab_revisions ADD COLUMN compacted_revision INTEGER NOT NULL DEFAULT 0"))
+
+
+def backfill_peer_tags(conn):
+    """Copy tags stored as JSON on client_ids into peer_tags
+
+    The JSON column is left as it is, so the release before peer_tags still
+    finds every tag from before the upgrade if it is rolled back to.
+    """
+    clients = main.ClientID.__table__
+    tagged = select(main.PeerTag.client_id).where(main.PeerTag.client_id == clients.c.id).exists()
+    legacy = conn.execute(
+        select(clients.c.id, clients.c.tags).where(clients.c.tags.is_not(None), ~tagged)
+    ).all()
+    rows = []
+    for id, tags in legacy:
+        try:
+            tags = json.loads(tags)
+        except ValueError:
+            tags = None
+        if isinstance(tags, list):
+            rows += [{"client_id": id, "tag": tag} for tag in dict.fromkeys(tags) if isinstance(tag, str) and tag]
+    if rows:
+        conn.execute(insert(main.PeerTag.__table__), rows)
+
+
+# PostgreSQL gets trigram GIN indexes so ILIKE '%term%' is an index scan,
+# SQLite an external content FTS5 table with the trigram tokenizer kept in
+# sync by triggers.
+PEER_SEARCH_COLUMNS = ("client_id", "alias", "notes")
+SQLITE_PEER_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS client_search USING fts5("
+    "client_id, alias, notes, content='client_ids', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS client_search_ai AFTER INSERT ON client_ids BEGIN "
+    "INSERT INTO client_search(rowid, client_id, alias, notes) VALUES (new.id, new.client_id, new.alias, new.notes); END",
+    "CREATE TRIGGER IF NOT EXISTS client_search_ad AFTER DELETE ON client_ids BEGIN "
+    "INSERT INTO client_search(client_search, rowid, client_id, alias, notes) "
+    "VALUES ('delete', old.id, old.client_id, old.alias, old.notes); END",
+    "CREATE TRIGGER IF NOT EXISTS client_search_au AFTER UPDATE OF client_id, alias, notes ON client_ids BEGIN "
+    "INSERT INTO client_search(client_search, rowid, client_id, alias, notes) "
+    "VALUES ('delete', old.id, old.client_id, old.alias, old.notes); "
+    "INSERT INTO client_search(rowid, client_id, alias, notes) VALUES (new.id, new.client_id, new.alias, new.notes); END",
+]
+POSTGRES_PEER_SEARCH_DDL = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+    f"CREATE INDEX IF NOT EXISTS ix_client_ids_{col}_trgm ON client_ids USING gin ({col} gin_trgm_ops)"
+    for col in PEER_SEARCH_COLUMNS
+]
+
+
+def create_peer_search_index(conn):
+    """Search indexes for the id/alias/note filters on /api/ab/peers"""
+    if conn.dialect.name == "postgresql":
+        for ddl in POSTGRES_PEER_SEARCH_DDL:
+            conn.execute(text(ddl))
+    elif conn.dialect.name == "sqlite":
+        if not sqlite_has_trigram():
+            # SQLite before 3.34 has no trigram tokenizer, searches fall back to LIKE scans
+            print("SQLite has no FTS5 trigram tokenizer, peer search will scan")
+            return
+        for ddl in SQLITE_PEER_SEARCH_DDL:
+            conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO client_search(client_search) VALUES ('rebuild')"))
+
+
+def sqlite_has_trigram() -> bool:
+    try:
+        sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE t USING fts5(a, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def backfill_effective_permissions(conn):
+    """Derive effective_permissions from the existing direct grants"""
+    for stmt in main.effective_permission_statements():
+        conn.execute(stmt)
+
+
+def create_auth_sessions(conn):
+    """auth_sessions, added with token revocation"""
+    main.AuthSession.__table__.create(bind=conn, checkfirst=True)
+
+def create_peer_status(conn):
+    """peer_status, added with heartbeat ingestion"""
+    main.PeerStatus.__table__.create(bind=conn, checkfirst=True)
+
+# (version, function), append only, never renumber
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_compacted_revision),
+    (3, backfill_peer_tags),
+    (4, create_peer_search_index),
+    (5, backfill_effective_permissions),
+    (6, create_auth_sessions),
+    (7, create_peer_status),
+]
+
+
+def applied_versions(engine) -> dict:
+    schema_migrations.create(bind=engine, checkfirst=True)
+    with engine.connect() as conn:
+        return {row.version: row for row in conn.execute(select(schema_migrations))}
+
+
+def upgrade(engine=None) -> list:
+    """Apply pending migrations in order, each in its own transaction, and return their versions"""
+    engine = engine or main.engine
+    applied = applied_versions(engine)
+    done = []
+    for version, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(insert(schema_migrations).values(
+                version=version, name=migration.__name__, applied_at=datetime.utcnow()
+            ))
+        done.append(version)
+    return done
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="MultiDesk API server database migrations")
+    parser.add_argument("--status", action="store_true", help="List migrations instead of applying them")
+    args = parser.parse_args()
+
+    if args.status:
+        applied = applied_versions(main.engine)
+        for version, migration in MIGRATIONS:
+            row = applied.get(version)
+            state = f"applied {row.applied_at.isoformat()}" if row else "pending"
+            print(f"{version:>4} {migration.__name__:<32} {state}")
+        return 0
+
+    done = upgrade()
+    names = dict(MIGRATIONS)
+    for version in done:
+        print(f"Applied migration {version}: {names[version].__name__}")
+    if not done:
+        print("Database is up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
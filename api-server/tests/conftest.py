@@ -0,0 +1,95 @@
+"""
+Shared fixtures for the API server tests
+
+Every test session runs the app in-process against a throwaway SQLite
+database migrated with migrate.py, so the configured DATABASE_URL is never
+touched. Tables and caches are emptied after each test.
+"""
+
+import os
+import sys
+import tempfile
+
+# Point the server at a scratch database before main is imported
+_tmpdir = tempfile.TemporaryDirectory(prefix="multidesk-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir.name}/test.db"
+# Background loops stay idle, tests flush and refresh explicitly
+os.environ["PRESENCE_FLUSH_SECONDS"] = "3600"
+os.environ["REVOCATION_REFRESH_SECONDS"] = "3600"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+
+import main
+import migrate
+
+# Cheap hashes, the tests exercise the endpoints rather than bcrypt
+main.pwd_context.update(bcrypt__rounds=4)
+migrate.upgrade()
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    yield
+    with main.engine.begin() as conn:
+        for table in reversed(main.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    main.auth_cache.clear()
+    main.permission_cache.clear()
+    main.presence._pending.clear()
+    main.revoked_tokens._revoked.clear()
+
+
+@pytest.fixture
+def make_user(client):
+    """Create a user and log them in, returns (id, request headers)"""
+    def make_user(username: str, role: str = "user") -> tuple:
+        with main.SessionLocal() as db:
+            user = main.User(username=username, password_hash=main.get_password_hash(username), role=role)
+            db.add(user)
+            db.commit()
+            user_id = user.id
+        response = client.post("/api/login", json={"username": username, "password": username})
+        assert response.status_code == 200, response.text
+        return user_id, {"Authorization": f"Bearer {response.json()['access_token']}"}
+    return make_user
+
+
+@pytest.fixture
+def admin(make_user):
+    return make_user("admin", "admin")
+
+
+@pytest.fixture
+def seed_clients(admin):
+    """Insert clients with the given client IDs, bypassing the API, and return their ids"""
+    def seed_clients(client_ids: list, tags: tuple = ()) -> list:
+        with main.engine.begin() as conn:
+            ids = conn.execute(insert(main.ClientID).returning(main.ClientID.id), [
+                {"client_id": c, "alias": f"host-{c}", "notes": "", "created_by": admin[0]} for c in client_ids
+            ]).scalars().all()
+            if tags:
+                conn.execute(insert(main.PeerTag), [{"client_id": id, "tag": tag} for id in ids for tag in tags])
+        return ids
+    return seed_clients
+
+
+@pytest.fixture
+def grant():
+    """Grant a user permission_type on clients, bypassing the API"""
+    def grant(user_id: int, client_ids: list, permission_type: str = "read"):
+        with main.engine.begin() as conn:
+            conn.execute(insert(main.UserClientPermission), [
+                {"user_id": user_id, "client_id": id, "permission_type": permission_type} for id in client_ids
+            ])
+            for stmt in main.effective_permission_statements([user_id], client_ids):
+                conn.execute(stmt)
+    return grant
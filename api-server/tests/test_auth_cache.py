@@ -0,0 +1,82 @@
+"""
+Auth cache: verified tokens are reused until the user changes, counted in /api/admin/stats
+"""
+
+import pytest
+
+import main
+
+
+def token_of(headers: dict) -> str:
+    return headers["Authorization"].split()[1]
+
+
+def cached(headers: dict) -> bool:
+    return token_of(headers) in main.auth_cache._data
+
+
+def warm_grants(client, headers):
+    """A peer write, which remembers the user's grants in permission_cache"""
+    response = client.put("/api/ab/peer/update/default", json={"id": "100000000", "note": "x"}, headers=headers)
+    assert response.json() == {"message": "Success"}
+
+
+def counters(client, admin) -> tuple:
+    """(hits, misses) before this call's own lookup of the admin's token, which is a hit"""
+    stats = client.get("/api/admin/stats", headers=admin[1]).json()["auth_cache"]
+    return stats["hits"] - 1, stats["misses"]
+
+
+def test_hits_and_misses_are_counted(client, admin, make_user):
+    _, headers = make_user("user")
+    client.get("/api/currentUser", headers=admin[1])
+    hits, misses = counters(client, admin)
+    client.get("/api/currentUser", headers=headers)
+    client.get("/api/currentUser", headers=headers)
+    client.get("/api/currentUser", headers=headers)
+    assert counters(client, admin) == (hits + 1 + 2, misses + 1)
+    assert cached(headers)
+
+
+def test_role_change_evicts_the_token(client, admin, make_user, seed_clients, grant):
+    user_id, headers = make_user("user")
+    grant(user_id, seed_clients(["100000000"]), "write")
+    warm_grants(client, headers)
+    assert client.get("/api/currentUser", headers=headers).json()["role"] == "user"
+    assert cached(headers) and user_id in main.permission_cache._data
+    client.put(f"/api/admin/users/{user_id}", json={"role": "admin"}, headers=admin[1])
+    assert not cached(headers)
+    _, misses = counters(client, admin)
+    assert client.get("/api/currentUser", headers=headers).json()["role"] == "admin"
+    assert counters(client, admin)[1] == misses + 1
+    # The user's other grants were dropped along with the token
+    assert user_id not in main.permission_cache._data
+
+
+def test_password_change_evicts_the_token(client, admin, make_user):
+    user_id, headers = make_user("user")
+    client.get("/api/currentUser", headers=headers)
+    client.put(f"/api/admin/users/{user_id}", json={"password": "changed"}, headers=admin[1])
+    assert not cached(headers)
+
+
+def test_delete_evicts_the_token(client, admin, make_user):
+    user_id, headers = make_user("user")
+    _, other = make_user("other")
+    client.get("/api/currentUser", headers=headers)
+    client.get("/api/currentUser", headers=other)
+    client.delete(f"/api/admin/users/{user_id}", headers=admin[1])
+    assert not cached(headers)
+    assert cached(other)
+    assert client.get("/api/currentUser", headers=headers).status_code == 401
+
+
+@pytest.mark.parametrize("kind", ["user", "permissions"])
+def test_invalidations_from_other_workers(client, make_user, seed_clients, grant, kind):
+    user_id, headers = make_user("user")
+    grant(user_id, seed_clients(["100000000"]), "write")
+    warm_grants(client, headers)
+    assert cached(headers) and user_id in main.permission_cache._data
+    main.apply_invalidation(kind, user_id)
+    assert cached(headers) == (kind == "permissions")
+    assert user_id not in main.permission_cache._data
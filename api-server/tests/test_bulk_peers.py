@@ -0,0 +1,68 @@
+"""
+Bulk peer upsert: created vs updated, permission re-checks and password hashing
+"""
+
+from sqlalchemy import select
+
+import main
+
+
+def grants_of(user_id: int) -> dict:
+    with main.engine.connect() as conn:
+        return dict(conn.execute(
+            select(main.ClientID.client_id, main.UserClientPermission.permission_type).join(
+                main.UserClientPermission, main.UserClientPermission.client_id == main.ClientID.id
+            ).where(main.UserClientPermission.user_id == user_id)
+        ).all())
+
+
+def test_creates_and_updates(client, make_user, seed_clients, grant):
+    user_id, headers = make_user("user")
+    ids = seed_clients(["100000000", "100000001"])
+    grant(user_id, ids[:1], "write")
+    response = client.post("/api/ab/peer/bulk/default", headers=headers, json=[
+        {"id": "100000000", "alias": "renamed"},
+        {"id": "100000001", "alias": "not mine"},
+        {"id": "200000000", "alias": "new", "tags": ["a"]},
+    ]).json()
+    assert [r["result"] for r in response["data"]] == ["updated", "error", "created"]
+    assert (response["created"], response["updated"], response["failed"]) == (1, 1, 1)
+    assert grants_of(user_id) == {"100000000": "write", "200000000": "admin"}
+
+
+def test_peer_created_meanwhile_is_not_reported_as_created(client, make_user, admin, seed_clients, monkeypatch):
+    """A peer another request created after the lookup is an update for admins and denied for others"""
+    user_id, headers = make_user("user")
+    seed_clients(["100000000"])
+
+    async def lookup_before_it_existed(user, client_ids, db):
+        return {}
+
+    monkeypatch.setattr(main, "get_clients_for_user", lookup_before_it_existed)
+    response = client.post("/api/ab/peer/bulk/default", headers=headers, json=[{"id": "100000000", "alias": "x"}]).json()
+    assert response["data"] == [{"id": "100000000", "result": "error", "error": "Permission denied"}]
+    assert grants_of(user_id) == {}
+
+    response = client.post("/api/ab/peer/bulk/default", headers=admin[1], json=[{"id": "100000000", "alias": "x"}]).json()
+    assert response["data"] == [{"id": "100000000", "result": "updated"}]
+    assert grants_of(admin[0]) == {}
+
+
+def test_passwords_are_hashed_in_small_jobs(client, admin, monkeypatch):
+    jobs = []
+    run = main.password_pool.run
+
+    async def record_job(fn, *args):
+        if fn is main.get_password_hashes:
+            jobs.append(len(args[0]))
+        return await run(fn, *args)
+
+    monkeypatch.setattr(main.password_pool, "run", record_job)
+    peers = [{"id": f"{200000000 + i}", "password": f"secret-{i}"} for i in range(20)]
+    response = client.post("/api/ab/peer/bulk/default", headers=admin[1], json=peers).json()
+    assert response["created"] == 20
+    assert jobs == [main.BULK_HASH_CHUNK, main.BULK_HASH_CHUNK, 20 - 2 * main.BULK_HASH_CHUNK]
+    with main.engine.connect() as conn:
+        hashes = conn.execute(select(main.ClientID.password_hash).order_by(main.ClientID.client_id)).scalars().all()
+    assert main.verify_password("secret-0", hashes[0])
+    assert main.verify_password("secret-19", hashes[-1])
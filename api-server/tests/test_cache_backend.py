@@ -0,0 +1,65 @@
+"""
+Cache backends: shared values and invalidations, and nothing blocking the caller
+"""
+
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def backends(tmp_path):
+    """Two workers sharing one SQLite cache file"""
+    path = str(tmp_path / "cache.db")
+    first, second = main.SQLiteCacheBackend(path), main.SQLiteCacheBackend(path)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_values_and_invalidations_are_shared(backends):
+    first, second = backends
+    asyncio.run(first.poll())
+    asyncio.run(second.poll())
+    first.set("recent_write:1", 7, ttl=60)
+    assert asyncio.run(first.get("recent_write:1")) == 7  # read back before it is written
+    first.publish("user", 1)
+    first.close()
+    assert asyncio.run(second.get("recent_write:1")) == 7
+    assert asyncio.run(second.poll()) == [("user", 1)]
+    assert asyncio.run(first.poll()) == []  # its own event is skipped
+
+
+def test_set_and_publish_do_not_wait_for_the_file(backends, tmp_path):
+    first, second = backends
+    asyncio.run(second.poll())
+    holder = sqlite3.connect(str(tmp_path / "cache.db"), isolation_level=None)
+    holder.execute("BEGIN EXCLUSIVE")
+    try:
+        start = time.perf_counter()
+        first.set("recent_write:1", 7, ttl=60)
+        first.publish("user", 1)
+        assert time.perf_counter() - start < 0.1
+        assert first.stats()["queued"] >= 1
+        assert asyncio.run(first.get("recent_write:1")) == 7
+    finally:
+        holder.rollback()
+        holder.close()
+    first.close()
+    assert first.stats()["queued"] == 0
+    assert asyncio.run(second.get("recent_write:1")) == 7
+    assert asyncio.run(second.poll()) == [("user", 1)]
+
+
+def test_memory_backend_has_its_own_size(monkeypatch):
+    monkeypatch.setattr(main, "CACHE_SIZE", 2)
+    monkeypatch.setattr(main, "AUTH_CACHE_SIZE", 100)
+    backend = main.MemoryCacheBackend()
+    for i in range(3):
+        backend.set(f"recent_write:{i}", i, ttl=60)
+    assert asyncio.run(backend.get("recent_write:0")) is None
+    assert asyncio.run(backend.get("recent_write:2")) == 2
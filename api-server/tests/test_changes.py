@@ -0,0 +1,103 @@
+"""
+Change log: /api/ab/changes returns what changed since a revision, per reader
+"""
+
+from sqlalchemy import update
+
+import main
+
+
+def changes(client, headers, since: int) -> dict:
+    return client.get(f"/api/ab/changes?since={since}", headers=headers).json()
+
+
+def revision(client, headers) -> int:
+    return changes(client, headers, 0)["revision"]
+
+
+def test_upserts_since_a_revision(client, admin):
+    for id in ("100000000", "100000001"):
+        client.post("/api/ab/peer/add/default", json={"id": id, "tags": ["a"]}, headers=admin[1])
+    since = revision(client, admin[1])
+    client.put("/api/ab/peer/update/default", json={"id": "100000001", "alias": "renamed"}, headers=admin[1])
+    client.post("/api/ab/peer/add/default", json={"id": "100000002"}, headers=admin[1])
+    body = changes(client, admin[1], since)
+    assert body["revision"] == since + 2
+    assert body["reset"] is False
+    assert [(peer["id"], peer["alias"]) for peer in body["upserts"]] == [
+        ("100000001", "renamed"), ("100000002", "100000002")
+    ]
+    assert body["upserts"][0]["tags"] == ["a"]
+    assert body["deletes"] == []
+    assert changes(client, admin[1], body["revision"]) == {
+        "revision": body["revision"], "reset": False, "upserts": [], "deletes": []
+    }
+
+
+def test_deletes_since_a_revision(client, admin, seed_clients):
+    seed_clients(["100000000", "100000001"])
+    since = revision(client, admin[1])
+    client.delete("/api/ab/peer/delete/default/100000000", headers=admin[1])
+    body = changes(client, admin[1], since)
+    assert body["upserts"] == []
+    assert body["deletes"] == ["100000000"]
+
+
+def test_readers_only_see_their_peers(client, admin, make_user, seed_clients, grant):
+    user_id, user = make_user("user")
+    _, other = make_user("other")
+    ids = seed_clients(["100000000", "100000001"])
+    grant(user_id, ids[:1])
+    since = revision(client, admin[1])
+    for id in ("100000000", "100000001"):
+        client.put("/api/ab/peer/update/default", json={"id": id, "note": "x"}, headers=admin[1])
+    assert [peer["id"] for peer in changes(client, user, since)["upserts"]] == ["100000000"]
+    assert changes(client, other, since)["upserts"] == []
+
+
+def test_grantees_get_tombstones(client, admin, make_user, seed_clients, grant):
+    user_id, user = make_user("user")
+    _, other = make_user("other")
+    ids = seed_clients(["100000000", "100000001"])
+    grant(user_id, ids)
+    since = revision(client, admin[1])
+    client.delete("/api/ab/peer/delete/default/100000000", headers=admin[1])
+    client.post("/api/admin/permissions/bulk-revoke", json={"user_id": user_id, "client_ids": ids[1:]}, headers=admin[1])
+    assert changes(client, user, since)["deletes"] == ["100000000", "100000001"]
+    # Users who never had the peers hear nothing about them
+    assert changes(client, other, since)["deletes"] == []
+
+
+def test_grant_is_an_upsert_for_the_grantee(client, admin, make_user, seed_clients):
+    user_id, user = make_user("user")
+    [client_pk] = seed_clients(["100000000"])
+    since = revision(client, admin[1])
+    client.post("/api/admin/permissions/grant", json={
+        "user_id": user_id, "client_id": client_pk, "permission_type": "read"
+    }, headers=admin[1])
+    assert [peer["id"] for peer in changes(client, user, since)["upserts"]] == ["100000000"]
+
+
+def test_role_change_resets_that_user(client, admin, make_user, seed_clients):
+    user_id, user = make_user("user")
+    _, other = make_user("other")
+    seed_clients(["100000000"])
+    since = revision(client, admin[1])
+    client.put(f"/api/admin/users/{user_id}", json={"role": "admin"}, headers=admin[1])
+    body = changes(client, user, since)
+    assert body == {"revision": since + 1, "reset": True, "upserts": [], "deletes": []}
+    assert changes(client, other, since)["reset"] is False
+
+
+def test_compacted_log_resets(client, admin):
+    client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1])
+    client.post("/api/ab/peer/add/default", json={"id": "100000001"}, headers=admin[1])
+    current = revision(client, admin[1])
+    with main.engine.begin() as conn:
+        conn.execute(update(main.AddressBookRevision).values(compacted_revision=current - 1))
+    assert changes(client, admin[1], current - 2)["reset"] is True
+    assert changes(client, admin[1], current - 1)["reset"] is False
+
+
+def test_unknown_revision(client, admin):
+    assert changes(client, admin[1], revision(client, admin[1]) + 1) == {"error": "Unknown revision"}
@@ -0,0 +1,145 @@
+"""
+Materialized permissions: effective_permissions follows direct and group grants
+"""
+
+import pytest
+from sqlalchemy import event, select
+
+import main
+
+
+def effective(user_id: int) -> dict:
+    """client id -> permission type, as materialized for the user"""
+    with main.engine.connect() as conn:
+        return dict(conn.execute(select(
+            main.EffectivePermission.client_id, main.EffectivePermission.permission_type
+        ).where(main.EffectivePermission.user_id == user_id)).all())
+
+
+def all_effective() -> set:
+    with main.engine.connect() as conn:
+        return set(conn.execute(select(main.EffectivePermission.__table__)).all())
+
+
+@pytest.fixture
+def groups(client, admin, make_user, seed_clients):
+    """A user in group staff, four peers, the last two in client group servers"""
+    user_id, headers = make_user("user")
+    ids = seed_clients([f"{100000000 + i}" for i in range(4)])
+
+    def create(kind: str, name: str, members: list) -> int:
+        group_id = client.post(f"/api/admin/groups/{kind}", json={"name": name}, headers=admin[1]).json()["id"]
+        client.put(f"/api/admin/groups/{kind}/{group_id}/members", json={"add": members}, headers=admin[1])
+        return group_id
+
+    staff = create("users", "staff", [user_id])
+    servers = create("clients", "servers", ids[2:])
+    yield {"user_id": user_id, "headers": headers, "ids": ids, "staff": staff, "servers": servers}
+    # Every incremental refresh left the same rows a full recompute derives
+    before = all_effective()
+    with main.engine.begin() as conn:
+        for stmt in main.effective_permission_statements():
+            conn.execute(stmt)
+    assert all_effective() == before
+
+
+@pytest.fixture
+def foreign_keys(client):
+    """Enforce foreign keys on the app's connections, as PostgreSQL always does"""
+    def enable(dbapi_connection, connection_record, connection_proxy):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+    event.listen(main.async_engine.sync_engine, "checkout", enable)
+    yield
+    event.remove(main.async_engine.sync_engine, "checkout", enable)
+    client.portal.call(main.async_engine.dispose)
+
+
+def group_grant(client, admin, groups, permission_type: str = "read"):
+    response = client.post("/api/admin/group-permissions/grant", json={
+        "user_group_id": groups["staff"], "client_group_id": groups["servers"], "permission_type": permission_type
+    }, headers=admin[1])
+    assert response.status_code == 200, response.text
+
+
+def visible(client, groups) -> list:
+    return [peer["id"] for peer in client.get("/api/ab/peers", headers=groups["headers"]).json()["data"]]
+
+
+def test_group_grant_gives_access(client, admin, groups):
+    assert visible(client, groups) == []
+    group_grant(client, admin, groups)
+    assert visible(client, groups) == ["100000002", "100000003"]
+    assert effective(groups["user_id"]) == {groups["ids"][2]: "read", groups["ids"][3]: "read"}
+    response = client.put("/api/ab/peer/update/default", json={"id": "100000002", "alias": "x"}, headers=groups["headers"])
+    assert response.json() == {"error": "Permission denied"}
+    group_grant(client, admin, groups, "write")
+    response = client.put("/api/ab/peer/update/default", json={"id": "100000002", "alias": "x"}, headers=groups["headers"])
+    assert response.json() == {"message": "Success"}
+
+
+def test_strongest_grant_wins_and_revoking_direct_keeps_group(client, admin, groups):
+    user_id, ids = groups["user_id"], groups["ids"]
+    group_grant(client, admin, groups)
+    client.post("/api/admin/permissions/grant", json={
+        "user_id": user_id, "client_id": ids[2], "permission_type": "write"
+    }, headers=admin[1])
+    assert effective(user_id)[ids[2]] == "write"
+    client.post("/api/admin/permissions/bulk-revoke", json={"user_id": user_id, "client_ids": [ids[2]]}, headers=admin[1])
+    assert effective(user_id) == {ids[2]: "read", ids[3]: "read"}
+    assert visible(client, groups) == ["100000002", "100000003"]
+
+
+def test_revoking_group_grant_keeps_direct(client, admin, groups, grant):
+    user_id, ids = groups["user_id"], groups["ids"]
+    grant(user_id, [ids[0], ids[3]])
+    group_grant(client, admin, groups, "write")
+    client.post("/api/admin/group-permissions/revoke", json={
+        "user_group_id": groups["staff"], "client_group_id": groups["servers"]
+    }, headers=admin[1])
+    assert effective(user_id) == {ids[0]: "read", ids[3]: "read"}
+
+
+def test_client_membership_changes_refresh_access(client, admin, groups):
+    ids = groups["ids"]
+    group_grant(client, admin, groups)
+    members = f"/api/admin/groups/clients/{groups['servers']}/members"
+    client.put(members, json={"add": [ids[0]], "remove": [ids[3]]}, headers=admin[1])
+    assert visible(client, groups) == ["100000000", "100000002"]
+
+
+def test_user_membership_changes_refresh_access(client, admin, groups, make_user):
+    other_id, other = make_user("other")
+    group_grant(client, admin, groups)
+    members = f"/api/admin/groups/users/{groups['staff']}/members"
+    client.put(members, json={"add": [other_id], "remove": [groups["user_id"]]}, headers=admin[1])
+    assert visible(client, groups) == []
+    assert effective(groups["user_id"]) == {}
+    assert set(effective(other_id)) == set(groups["ids"][2:])
+
+
+@pytest.mark.parametrize("kind", ["users", "clients"])
+def test_deleting_a_group_removes_its_access(client, admin, groups, grant, kind):
+    user_id, ids = groups["user_id"], groups["ids"]
+    grant(user_id, [ids[2]], "write")
+    group_grant(client, admin, groups)
+    group_id = groups["staff" if kind == "users" else "servers"]
+    assert client.delete(f"/api/admin/groups/{kind}/{group_id}", headers=admin[1]).status_code == 200
+    assert effective(user_id) == {ids[2]: "write"}
+
+
+def test_deleting_a_peer_drops_its_rows(client, admin, groups):
+    group_grant(client, admin, groups)
+    client.delete("/api/ab/peer/delete/default/100000003", headers=admin[1])
+    assert effective(groups["user_id"]) == {groups["ids"][2]: "read"}
+
+
+def test_deleting_a_granting_admin_keeps_the_group_grant(client, admin, groups, make_user, foreign_keys):
+    boss = make_user("boss", "admin")
+    group_grant(client, admin, groups)
+    group_grant(client, boss, groups)
+    response = client.delete(f"/api/admin/users/{boss[0]}", headers=admin[1])
+    assert response.json() == {"message": "User deleted"}
+    [grant] = client.get("/api/admin/group-permissions", headers=admin[1]).json()
+    assert grant["permission_type"] == "read"
+    assert visible(client, groups) == ["100000002", "100000003"]
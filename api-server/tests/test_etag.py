@@ -0,0 +1,48 @@
+"""
+Address book ETags: a client holding the current revision gets a 304
+"""
+
+import pytest
+
+READS = [("GET", "/api/ab/list"), ("GET", "/api/ab/peers"), ("POST", "/api/ab/peers?pageSize=10")]
+
+
+@pytest.mark.parametrize("method, path", READS)
+def test_matching_etag_gets_304(client, admin, seed_clients, method, path):
+    seed_clients(["100000000"])
+    first = client.request(method, path, headers=admin[1])
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+    again = client.request(method, path, headers={**admin[1], "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["ETag"] == etag
+    # Any of a list of tags matches, a stale or unknown one does not
+    listed = client.request(method, path, headers={**admin[1], "If-None-Match": f'"ab-x", {etag}'})
+    assert listed.status_code == 304
+    stale = client.request(method, path, headers={**admin[1], "If-None-Match": '"ab-x"'})
+    assert stale.status_code == 200
+    assert stale.content == first.content
+
+
+def test_write_changes_the_etag(client, admin):
+    etag = client.get("/api/ab/peers", headers=admin[1]).headers["ETag"]
+    client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1])
+    response = client.get("/api/ab/peers", headers={**admin[1], "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert [peer["id"] for peer in response.json()["data"]] == ["100000000"]
+
+
+def test_grant_changes_the_grantees_etag(client, admin, make_user, seed_clients):
+    user_id, headers = make_user("user")
+    [client_pk] = seed_clients(["100000000"])
+    etag = client.get("/api/ab/peers", headers=headers).headers["ETag"]
+    client.post("/api/admin/permissions/grant", json={
+        "user_id": user_id, "client_id": client_pk, "permission_type": "read"
+    }, headers=admin[1])
+    response = client.get("/api/ab/peers", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["total"] == 1
+
@@ -0,0 +1,80 @@
+"""
+Admin export: NDJSON and CSV content, and export -> `ab.py bulk-add` round trips
+"""
+
+import csv
+import importlib.util
+import io
+import json
+import os
+
+import pytest
+from sqlalchemy import delete
+
+import main
+
+spec = importlib.util.spec_from_file_location(
+    "ab", os.path.join(os.path.dirname(__file__), "..", "..", "res", "ab.py")
+)
+ab = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ab)
+
+PEERS = [
+    {"id": "100000000", "alias": "Front desk", "note": 'says "hi", twice', "tags": ["office", "a,b"]},
+    {"id": "100000001", "alias": "Back office", "note": "line one\nline two", "tags": []},
+    {"id": "100000002", "alias": "Ümlaut", "note": "", "tags": ["[weird]", " spaced "]},
+]
+
+
+@pytest.fixture
+def peers(client, admin):
+    for peer in PEERS:
+        assert client.post("/api/ab/peer/add/default", json=peer, headers=admin[1]).json() == {"message": "Success"}
+
+
+def export(client, admin, format: str) -> str:
+    response = client.get(f"/api/admin/export?format={format}", headers=admin[1])
+    assert response.status_code == 200
+    return response.text
+
+
+def book(client, admin) -> list:
+    """The address book as (id, alias, note, sorted tags)"""
+    data = client.get("/api/ab/peers", headers=admin[1]).json()["data"]
+    return [(p["id"], p["alias"], p["note"], sorted(p["tags"])) for p in data]
+
+
+def test_ndjson(client, admin, peers):
+    rows = [json.loads(line) for line in export(client, admin, "ndjson").splitlines()]
+    assert [{k: r[k] for k in ("id", "alias", "note", "tags")} for r in rows] == [
+        dict(p, tags=sorted(p["tags"])) for p in PEERS
+    ]
+    assert all(r["created_by"] == admin[0] and r["created_at"] for r in rows)
+
+
+def test_csv(client, admin, peers):
+    rows = list(csv.DictReader(io.StringIO(export(client, admin, "csv"))))
+    assert [r["id"] for r in rows] == [p["id"] for p in PEERS]
+    assert rows[1]["note"] == "line one\nline two"
+    assert [json.loads(r["tags"]) for r in rows] == [sorted(p["tags"]) for p in PEERS]
+
+
+def test_csv_tags_from_older_files(tmp_path):
+    path = tmp_path / "peers.csv"
+    path.write_text('id,tags\n1,"a, b"\n2,"[c,d]"\n3,"[""e,f""]"\n4,\n')
+    assert [p.get("tags") for p in ab.read_peers_file(str(path))] == [["a", "b"], ["c", "d"], ["e,f"], None]
+
+
+@pytest.mark.parametrize("format", ["ndjson", "csv"])
+def test_export_imports_back(client, admin, peers, tmp_path, format):
+    before = book(client, admin)
+    path = tmp_path / f"backup.{format}"
+    path.write_text(export(client, admin, format), encoding="utf-8")
+    with main.engine.begin() as conn:
+        conn.execute(delete(main.PeerTag))
+        conn.execute(delete(main.ClientID))
+    assert book(client, admin) == []
+
+    response = client.post("/api/ab/peer/bulk/default", json=list(ab.read_peers_file(str(path))), headers=admin[1])
+    assert (response.json()["created"], response.json()["failed"]) == (len(PEERS), 0)
+    assert book(client, admin) == before
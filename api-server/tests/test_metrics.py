@@ -0,0 +1,22 @@
+"""
+/metrics: admins only, or the scraper's METRICS_TOKEN when one is set
+"""
+
+import main
+
+
+def test_requires_an_admin_without_a_token(client, admin, make_user):
+    _, user_headers = make_user("user")
+    assert client.get("/metrics").status_code in (401, 403)
+    assert client.get("/metrics", headers={"Authorization": "Bearer nonsense"}).status_code == 401
+    assert client.get("/metrics", headers=user_headers).status_code == 403
+    response = client.get("/metrics", headers=admin[1])
+    assert response.status_code == 200
+    assert "multidesk_http_requests_total" in response.text
+
+
+def test_metrics_token(client, admin, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "scrape")
+    assert client.get("/metrics", headers={"Authorization": "Bearer scrape"}).status_code == 200
+    assert client.get("/metrics", headers=admin[1]).status_code == 401
+    assert client.get("/metrics").status_code == 401
@@ -0,0 +1,77 @@
+"""
+migrate.py: versions apply once and in order, data is carried into new tables
+"""
+
+import json
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, func, insert, select
+
+import main
+import migrate
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/ab.db")
+    yield engine
+    engine.dispose()
+
+
+def at_version(engine, version: int):
+    """Bring a fresh database to the schema and records of an older release"""
+    migrate.applied_versions(engine)
+    with engine.begin() as conn:
+        for applied, migration in migrate.MIGRATIONS[:version]:
+            migration(conn)
+            conn.execute(insert(migrate.schema_migrations).values(
+                version=applied, name=migration.__name__, applied_at=datetime.utcnow()
+            ))
+
+
+def test_upgrade_applies_each_migration_once(engine):
+    versions = [version for version, _ in migrate.MIGRATIONS]
+    assert versions == sorted(versions)
+    assert migrate.upgrade(engine) == versions
+    assert migrate.upgrade(engine) == []
+    assert sorted(migrate.applied_versions(engine)) == versions
+
+
+def test_upgrade_carries_legacy_tags_and_grants(engine):
+    at_version(engine, 2)
+    with engine.begin() as conn:
+        user_id = conn.execute(insert(main.User).values(username="user", password_hash="!").returning(main.User.id)).scalar()
+        ids = conn.execute(insert(main.ClientID).returning(main.ClientID.id), [
+            {"client_id": "100000000", "tags": json.dumps(["a", "b", "a", ""])},
+            {"client_id": "100000001", "tags": "not json"},
+            {"client_id": "100000002", "tags": None},
+        ]).scalars().all()
+        conn.execute(insert(main.UserClientPermission), [
+            {"user_id": user_id, "client_id": ids[0], "permission_type": "write"},
+        ])
+
+    assert migrate.upgrade(engine) == [3, 4, 5, 6, 7]
+
+    with engine.connect() as conn:
+        tags = conn.execute(select(main.PeerTag.client_id, main.PeerTag.tag).order_by(main.PeerTag.tag)).all()
+        assert tags == [(ids[0], "a"), (ids[0], "b")]
+        # The legacy column is left for the previous release to read after a rollback
+        legacy = conn.execute(select(main.ClientID.tags).order_by(main.ClientID.id)).scalars().all()
+        assert legacy == [json.dumps(["a", "b", "a", ""]), "not json", None]
+        effective = conn.execute(select(
+            main.EffectivePermission.user_id, main.EffectivePermission.client_id, main.EffectivePermission.permission_type
+        )).all()
+        assert effective == [(user_id, ids[0], "write")]
+
+
+def test_tag_backfill_skips_clients_already_in_peer_tags(engine):
+    at_version(engine, 2)
+    with engine.begin() as conn:
+        id = conn.execute(insert(main.ClientID).values(client_id="100000000", tags=json.dumps(["old"]))
+                          .returning(main.ClientID.id)).scalar()
+        conn.execute(insert(main.PeerTag).values(client_id=id, tag="current"))
+        migrate.backfill_peer_tags(conn)
+        migrate.backfill_peer_tags(conn)
+        assert conn.execute(select(main.PeerTag.tag)).scalars().all() == ["current"]
+        assert conn.execute(select(func.count()).select_from(main.PeerTag)).scalar() == 1
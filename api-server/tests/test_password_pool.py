@@ -0,0 +1,81 @@
+"""
+Password pool: bcrypt runs on a bounded set of low-priority threads, overflow gets a 503
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """A pool of one worker and one queue slot in place of the server's"""
+    pool = main.PasswordPool(1, 1, nice=5)
+    monkeypatch.setattr(main, "password_pool", pool)
+    return pool
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_full_pool_rejects_logins(client, make_user, pool):
+    make_user("user")
+    release = threading.Event()
+    started = threading.Event()
+
+    def hold():
+        started.set()
+        release.wait(5)
+
+    # One job running and one waiting fill the pool
+    futures = [client.portal.start_task_soon(pool.run, hold) for _ in range(2)]
+    try:
+        assert started.wait(5)
+        wait_for(lambda: pool.stats()["queued"] == 1)
+        response = client.post("/api/login", json={"username": "user", "password": "user"})
+        assert response.status_code == 503
+        stats = pool.stats()
+        assert (stats["running"], stats["queued"], stats["rejected"]) == (1, 1, 1)
+    finally:
+        release.set()
+        for future in futures:
+            future.result(5)
+    assert client.post("/api/login", json={"username": "user", "password": "user"}).status_code == 200
+
+
+def test_no_more_than_workers_run_at_once(client):
+    pool = main.PasswordPool(2, 10)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def job():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    async def burst():
+        await asyncio.gather(*(pool.run(job) for _ in range(8)))
+
+    client.portal.call(burst)
+    assert peak[0] == 2
+    assert pool.stats()["completed"] == 8
+
+
+@pytest.mark.skipif(not hasattr(os, "setpriority"), reason="no per-thread priorities")
+def test_password_threads_run_at_lower_priority(client, pool):
+    def niceness():
+        return os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+
+    assert client.portal.call(pool.run, niceness) == os.getpriority(os.PRIO_PROCESS, 0) + 5
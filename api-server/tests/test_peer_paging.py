@@ -0,0 +1,109 @@
+"""
+Peer pages: offset paging and keyset (cursor) paging over /api/ab/peers
+"""
+
+import pytest
+from sqlalchemy import event
+
+import main
+
+
+def walk(client, headers, page_size: int, query: str = "") -> list:
+    """Follow next cursors from the first page, returns the pages"""
+    pages = []
+    cursor = ""
+    while cursor is not None:
+        body = client.post(f"/api/ab/peers?cursor={cursor}&pageSize={page_size}{query}", headers=headers).json()
+        assert "total" not in body
+        pages.append([peer["id"] for peer in body["data"]])
+        cursor = body["next"]
+    return pages
+
+
+def test_cursor_pages_cover_the_book_once_in_order(client, admin, seed_clients):
+    client_ids = [f"{100000000 + i}" for i in range(7)]
+    seed_clients(list(reversed(client_ids)))
+    pages = walk(client, admin[1], 3)
+    assert pages == [client_ids[:3], client_ids[3:6], client_ids[6:]]
+
+
+def test_last_full_page_has_no_next(client, admin, seed_clients):
+    client_ids = [f"{100000000 + i}" for i in range(6)]
+    seed_clients(client_ids)
+    assert walk(client, admin[1], 3) == [client_ids[:3], client_ids[3:]]
+
+
+def test_empty_page(client, admin):
+    response = client.post("/api/ab/peers?cursor=&pageSize=10", headers=admin[1])
+    assert response.json() == {"data": [], "next": None}
+
+
+def test_cursor_pages_only_hold_permitted_peers(client, make_user, seed_clients, grant):
+    user_id, headers = make_user("user")
+    ids = seed_clients([f"{100000000 + i}" for i in range(6)], tags=("office",))
+    seed_clients(["200000000"], tags=("office",))
+    grant(user_id, ids[1::2])
+    assert walk(client, headers, 2) == [["100000001", "100000003"], ["100000005"]]
+    assert walk(client, headers, 2, "&tag=office") == [["100000001", "100000003"], ["100000005"]]
+
+
+def test_user_pages_follow_the_grant_index(client, admin, make_user, seed_clients, grant):
+    """Admins page the whole book by client ID, users and tag filters in the order peers were added"""
+    user_id, headers = make_user("user")
+    client_ids = [f"{100000000 + i}" for i in range(5)]
+    grant(user_id, seed_clients(list(reversed(client_ids)), tags=("office",)))
+    assert walk(client, admin[1], 2) == [client_ids[:2], client_ids[2:4], client_ids[4:]]
+    newest_first = list(reversed(client_ids))
+    assert walk(client, headers, 2) == [newest_first[:2], newest_first[2:4], newest_first[4:]]
+    assert walk(client, admin[1], 2, "&tag=office") == walk(client, headers, 2)
+
+
+@pytest.mark.parametrize("who, query", [("admin", ""), ("admin", "&tag=office"), ("user", ""), ("user", "&tag=office")])
+def test_cursor_pages_seek_an_index(client, admin, make_user, seed_clients, grant, who, query):
+    """A deep page reads pageSize rows of an index instead of sorting every peer in view"""
+    user_id, headers = make_user("user")
+    grant(user_id, seed_clients([f"{100000000 + i}" for i in range(20)], tags=("office",)))
+    headers = admin[1] if who == "admin" else headers
+    first = client.post(f"/api/ab/peers?cursor=&pageSize=5{query}", headers=headers).json()
+    pages = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if "LIMIT" in statement:
+            pages.append((statement, parameters))
+
+    event.listen(main.async_engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        client.post(f"/api/ab/peers?cursor={first['next']}&pageSize=5{query}", headers=headers)
+    finally:
+        event.remove(main.async_engine.sync_engine, "before_cursor_execute", capture)
+    [(statement, parameters)] = pages
+    raw = main.engine.raw_connection()
+    try:
+        plan = [row[3] for row in raw.cursor().execute("EXPLAIN QUERY PLAN " + statement, parameters)]
+    finally:
+        raw.close()
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def test_cursor_survives_inserts_before_it(client, admin, seed_clients):
+    seed_clients([f"{100000000 + i}" for i in range(4)])
+    first = client.post("/api/ab/peers?cursor=&pageSize=2", headers=admin[1]).json()
+    seed_clients(["000000001"])
+    second = client.post(f"/api/ab/peers?cursor={first['next']}&pageSize=2", headers=admin[1]).json()
+    assert [peer["id"] for peer in second["data"]] == ["100000002", "100000003"]
+
+
+def test_invalid_cursor(client, admin, seed_clients):
+    seed_clients(["100000000"])
+    for cursor in ("not-a-cursor", main.encode_cursor("100000000", 1)[:-2], "WzEsIDJd"):
+        response = client.post(f"/api/ab/peers?cursor={cursor}", headers=admin[1])
+        assert response.json() == {"error": "Invalid cursor"}, cursor
+
+
+def test_offset_pages_keep_total(client, admin, seed_clients):
+    seed_clients([f"{100000000 + i}" for i in range(5)])
+    body = client.post("/api/ab/peers?current=2&pageSize=2", headers=admin[1]).json()
+    assert body["total"] == 5
+    assert [peer["id"] for peer in body["data"]] == ["100000002", "100000003"]
+    body = client.post("/api/ab/peers?current=4&pageSize=2", headers=admin[1]).json()
+    assert body == {"total": 5, "data": []}
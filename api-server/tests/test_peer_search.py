@@ -0,0 +1,133 @@
+"""
+Peer search: id/alias/note substring filters, through FTS5 or a scan
+"""
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event, text
+
+import main
+
+PEERS = [
+    {"id": "100000000", "alias": "Front Desk", "note": "50%_off printer"},
+    {"id": "100000001", "alias": "back-office", "note": "50 percent"},
+    {"id": "100000002", "alias": 'say "hi"', "note": "a_b"},
+    {"id": "200000000", "alias": "server", "note": "axb"},
+]
+
+
+@pytest.fixture
+def peers(client, admin):
+    for peer in PEERS:
+        assert client.post("/api/ab/peer/add/default", json=peer, headers=admin[1]).json() == {"message": "Success"}
+
+
+@pytest.fixture(params=[True, False], ids=["fts", "scan"])
+def fts(request, monkeypatch):
+    """Run a search test against the client_search table and against the LIKE fallback"""
+    assert main.async_engine.dialect.name == "sqlite" and main.peer_search_fts is not False
+    monkeypatch.setattr(main, "peer_search_fts", request.param)
+    return request.param
+
+
+@contextmanager
+def statements():
+    seen = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        seen.append(statement)
+
+    event.listen(main.async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield seen
+    finally:
+        event.remove(main.async_engine.sync_engine, "before_cursor_execute", record)
+
+
+def search(client, headers, **terms) -> list:
+    body = client.get("/api/ab/peers", params=terms, headers=headers).json()
+    return [peer["id"] for peer in body["data"]]
+
+
+def assert_index_in_sync():
+    """FTS5 compares the external content table with its index and raises on any difference"""
+    with main.engine.begin() as conn:
+        conn.execute(text("INSERT INTO client_search(client_search) VALUES ('integrity-check')"))
+
+
+@pytest.mark.parametrize("terms, expected", [
+    ({"id": "0000000"}, ["100000000", "100000001", "100000002", "200000000"]),
+    ({"id": "20000"}, ["200000000"]),
+    ({"alias": "FRONT"}, ["100000000"]),
+    ({"alias": "ck-Of"}, ["100000001"]),
+    ({"note": "percent"}, ["100000001"]),
+    ({"alias": "desk", "note": "printer"}, ["100000000"]),
+    ({"alias": "desk", "note": "percent"}, []),
+    ({"alias": "%server%"}, ["200000000"]),  # RustDesk clients send the term wrapped in wildcards
+])
+def test_substring_match(client, admin, peers, fts, terms, expected):
+    assert search(client, admin[1], **terms) == expected
+
+
+@pytest.mark.parametrize("terms, expected", [
+    ({"note": "0%_o"}, ["100000000"]),
+    ({"note": "0%_"}, ["100000000"]),
+    ({"note": "a_b"}, ["100000002"]),
+    ({"note": "_b"}, ["100000002"]),
+    ({"alias": '"hi"'}, ["100000002"]),
+    ({"alias": 'y "h'}, ["100000002"]),
+])
+def test_wildcards_and_quotes_are_literal(client, admin, peers, fts, terms, expected):
+    assert search(client, admin[1], **terms) == expected
+
+
+def test_long_terms_use_the_index(client, admin, peers):
+    with statements() as seen:
+        assert search(client, admin[1], alias="desk") == ["100000000"]
+    assert any("client_search MATCH" in s for s in seen)
+    assert not any("LIKE" in s.upper() for s in seen)
+
+
+def test_short_terms_scan(client, admin, peers):
+    with statements() as seen:
+        assert search(client, admin[1], alias="ck") == ["100000001"]
+        assert search(client, admin[1], note="b") == ["100000002", "200000000"]
+    assert not any("client_search" in s for s in seen)
+
+
+def test_search_only_returns_permitted_peers(client, admin, make_user, peers, fts):
+    user_id, headers = make_user("user")
+    with main.engine.begin() as conn:
+        ids = conn.execute(text("SELECT id FROM client_ids WHERE client_id LIKE '1%'")).scalars().all()
+    client.post("/api/admin/permissions/bulk-grant", json={"user_id": user_id, "client_ids": ids[:1]}, headers=admin[1])
+    assert search(client, headers, id="0000000") == ["100000000"]
+
+
+def test_index_follows_updates(client, admin, peers, fts):
+    client.put("/api/ab/peer/update/default", json={"id": "100000000", "alias": "Reception"}, headers=admin[1])
+    assert search(client, admin[1], alias="desk") == []
+    assert search(client, admin[1], alias="recep") == ["100000000"]
+    # The note was not touched and is still found
+    assert search(client, admin[1], note="printer") == ["100000000"]
+    assert_index_in_sync()
+
+
+def test_index_follows_bulk_inserts_and_updates(client, admin, peers, fts):
+    response = client.post("/api/ab/peer/bulk/default", json=[
+        {"id": "300000000", "alias": "warehouse"},
+        {"id": "300000001", "alias": "Warehouse 2"},
+        {"id": "200000000", "alias": "old server"},
+    ], headers=admin[1]).json()
+    assert (response["created"], response["updated"]) == (2, 1)
+    assert search(client, admin[1], alias="wareh") == ["300000000", "300000001"]
+    assert search(client, admin[1], alias="old ser") == ["200000000"]
+    assert_index_in_sync()
+
+
+def test_index_follows_deletes(client, admin, peers, fts):
+    client.delete("/api/ab/peer/delete/default/100000000", headers=admin[1])
+    client.request("DELETE", "/api/ab/peer/default", json=["100000001"], headers=admin[1])
+    assert search(client, admin[1], id="0000000") == ["100000002", "200000000"]
+    assert search(client, admin[1], alias="desk") == []
+    assert_index_in_sync()
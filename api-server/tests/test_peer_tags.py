@@ -0,0 +1,41 @@
+"""
+Peer tags: stored one row per tag, whatever shape a client sends them in
+"""
+
+import pytest
+
+
+def peer_tags(client, headers, client_id: str) -> list:
+    peers = client.post("/api/ab/peers", headers=headers).json()["data"]
+    return next(p["tags"] for p in peers if p["id"] == client_id)
+
+
+@pytest.mark.parametrize("tags, stored", [
+    (["b", "a", "b", ""], ["a", "b"]),
+    ("office", ["office"]),
+    ([], []),
+    (None, []),
+    (["ok", 5, None], ["ok"]),
+    ({"a": 1}, []),
+])
+def test_add_and_update_peer_tags(client, admin, tags, stored):
+    client.post("/api/ab/peer/add/default", json={"id": "100000000", "tags": ["old"]}, headers=admin[1])
+    response = client.put("/api/ab/peer/update/default", json={"id": "100000000", "tags": tags}, headers=admin[1])
+    assert response.json() == {"message": "Success"}
+    assert peer_tags(client, admin[1], "100000000") == stored
+    response = client.post("/api/ab/peer/add/default", json={"id": "100000001", "tags": tags}, headers=admin[1])
+    assert response.json() == {"message": "Success"}
+    assert peer_tags(client, admin[1], "100000001") == stored
+
+
+def test_bulk_peer_with_a_single_tag_string(client, admin):
+    response = client.post("/api/ab/peer/bulk/default", json=[{"id": "100000000", "tags": "abc"}], headers=admin[1])
+    assert response.json()["created"] == 1
+    assert peer_tags(client, admin[1], "100000000") == ["abc"]
+
+
+def test_tag_filter(client, admin):
+    for client_id, tags in (("100000000", ["linux"]), ("100000001", ["windows"]), ("100000002", "linux")):
+        client.post("/api/ab/peer/add/default", json={"id": client_id, "tags": tags}, headers=admin[1])
+    peers = client.post("/api/ab/peers?tag=linux", headers=admin[1]).json()["data"]
+    assert [p["id"] for p in peers] == ["100000000", "100000002"]
@@ -0,0 +1,73 @@
+"""
+Device presence: buffered per device, written in one batch, kept out of the revision
+"""
+
+from sqlalchemy import select
+
+import main
+
+
+def peer_status() -> dict:
+    with main.engine.connect() as conn:
+        return {row.client_id: row for row in conn.execute(select(main.PeerStatus))}
+
+
+def test_reports_are_batched_per_device(client, admin, seed_clients):
+    seed_clients(["100000000", "100000001"])
+    client.post("/api/heartbeat", json={"id": "100000000"})
+    client.post("/api/sysinfo", json={"id": "100000000", "hostname": "old", "os": "Linux"})
+    client.post("/api/sysinfo", json={"id": "100 000 000", "hostname": "new", "username": "alice"})
+    client.post("/api/heartbeat", json={"id": "100000001"})
+    client.post("/api/heartbeat", json={"id": "999999999"})  # in no address book
+    assert peer_status() == {}
+
+    written = main.presence.written
+    client.portal.call(main.presence.flush)
+    assert main.presence.written == written + 2
+    status = peer_status()
+    assert set(status) == {"100000000", "100000001"}
+    assert (status["100000000"].hostname, status["100000000"].username, status["100000000"].platform) == \
+        ("new", "alice", "Linux")
+    assert status["100000001"].hostname is None
+
+
+def test_heartbeat_keeps_reported_sysinfo(client, admin, seed_clients):
+    seed_clients(["100000000"])
+    client.post("/api/sysinfo", json={"id": "100000000", "hostname": "box", "platform": "Windows"})
+    client.portal.call(main.presence.flush)
+    first_seen = peer_status()["100000000"].last_seen
+    client.post("/api/heartbeat", json={"id": "100000000"})
+    client.portal.call(main.presence.flush)
+    status = peer_status()["100000000"]
+    assert (status.hostname, status.platform) == ("box", "Windows")
+    assert status.last_seen >= first_seen
+    peer = client.post("/api/ab/peers", headers=admin[1]).json()["data"][0]
+    assert (peer["hostname"], peer["platform"]) == ("box", "Windows")
+
+
+def test_presence_leaves_revision_and_change_log_alone(client, admin):
+    client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1])
+    before = client.get("/api/ab/changes?since=0", headers=admin[1]).json()
+    etag = client.post("/api/ab/peers", headers=admin[1]).headers["ETag"]
+
+    client.post("/api/sysinfo", json={"id": "100000000", "hostname": "spoofed", "username": "x", "os": "y"})
+    client.post("/api/heartbeat", json={"id": "100000000"})
+    client.portal.call(main.presence.flush)
+
+    assert client.get("/api/ab/changes?since=0", headers=admin[1]).json()["revision"] == before["revision"]
+    assert client.get(f"/api/ab/changes?since={before['revision']}", headers=admin[1]).json()["upserts"] == []
+    assert client.post("/api/ab/peers", headers=admin[1]).headers["ETag"] == etag
+
+
+def test_sysinfo_without_id(client):
+    assert client.post("/api/sysinfo", json={"hostname": "x"}).text == "ID_NOT_FOUND"
+    assert main.presence.stats()["pending"] == 0
+
+
+def test_full_buffer_drops_new_devices(client, monkeypatch):
+    monkeypatch.setattr(main.presence, "maxsize", 2)
+    dropped = main.presence.dropped
+    for client_id in ("100000000", "100000001", "100000002", "100000000"):
+        client.post("/api/heartbeat", json={"id": client_id})
+    assert main.presence.stats()["pending"] == 2
+    assert main.presence.dropped == dropped + 1
@@ -0,0 +1,64 @@
+"""
+Read replica routing: reads go to the replica unless it has not caught up with the reader's own write
+"""
+
+import pytest
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import main
+import migrate
+
+
+@pytest.fixture
+def replica(client, tmp_path, monkeypatch):
+    """A second database standing in for a replica that replays only what a test copies into it"""
+    url = f"sqlite:///{tmp_path}/replica.db"
+    sync_engine = create_engine(url)
+    migrate.upgrade(sync_engine)
+    read_engine = create_async_engine(main.get_async_database_url(url))
+    monkeypatch.setattr(main, "read_engine", read_engine)
+    monkeypatch.setattr(main, "AsyncReadSessionLocal", async_sessionmaker(read_engine, expire_on_commit=False))
+    statements = []
+    event.listen(read_engine.sync_engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    yield sync_engine, statements
+    client.portal.call(read_engine.dispose)
+    sync_engine.dispose()
+
+
+def replay(sync_engine, revision: int, client_ids: list):
+    with sync_engine.begin() as conn:
+        conn.execute(main.AddressBookRevision.__table__.delete())
+        conn.execute(insert(main.AddressBookRevision).values(guid="default", revision=revision))
+        conn.execute(insert(main.ClientID), [{"client_id": c} for c in client_ids])
+
+
+def peer_ids(client, headers) -> list:
+    return [p["id"] for p in client.post("/api/ab/peers", headers=headers).json()["data"]]
+
+
+def test_writer_reads_primary_until_replica_catches_up(client, admin, make_user, replica):
+    sync_engine, statements = replica
+    _, other = make_user("other", "admin")
+    client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1])
+    routing = dict(main.read_routing)
+
+    # The replica is behind: the writer is sent to the primary and sees their peer
+    assert peer_ids(client, admin[1]) == ["100000000"]
+    assert main.read_routing["primary"] == routing["primary"] + 1
+    # Everyone else reads the replica as it is, without a revision check
+    statements.clear()
+    assert client.get("/api/ab/list", headers=other).status_code == 200
+    assert main.read_routing["replica"] == routing["replica"] + 1
+    assert len([s for s in statements if "ab_revisions" in s]) == 1
+
+    replay(sync_engine, 1, ["100000000"])
+    statements.clear()
+    response = client.post("/api/ab/peers", headers=admin[1])
+    assert [p["id"] for p in response.json()["data"]] == ["100000000"]
+    assert main.read_routing["replica"] == routing["replica"] + 2
+    assert response.headers["ETag"] == '"ab-1"'
+    # The revision checked for routing is the one used for the ETag
+    assert len([s for s in statements if "ab_revisions" in s]) == 1
+
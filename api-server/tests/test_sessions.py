@@ -0,0 +1,90 @@
+"""
+Sessions: every login is revocable, on this worker at once and on the others at their next refresh
+"""
+
+from datetime import datetime, timedelta
+
+from jose import jwt
+from sqlalchemy import func, insert, select, update
+
+import main
+
+
+def session_count() -> int:
+    with main.engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(main.AuthSession)).scalar()
+
+
+def test_login_issues_a_session_token(client, make_user):
+    user_id, headers = make_user("user")
+    token = headers["Authorization"].split()[1]
+    claims = jwt.decode(token, main.SECRET_KEY, algorithms=[main.ALGORITHM])
+    with main.engine.connect() as conn:
+        session = conn.execute(select(main.AuthSession)).one()
+    assert (session.jti, session.user_id) == (claims["jti"], user_id)
+    assert session.revoked_at is None
+
+
+def test_logout_revokes_only_that_token(client, make_user):
+    _, first = make_user("user")
+    second = {"Authorization": "Bearer " + client.post(
+        "/api/login", json={"username": "user", "password": "user"}
+    ).json()["access_token"]}
+    assert client.get("/api/currentUser", headers=first).status_code == 200  # cached from here on
+    assert client.post("/api/logout", headers=first).status_code == 200
+    assert client.get("/api/currentUser", headers=first).status_code == 401
+    assert client.get("/api/currentUser", headers=second).status_code == 200
+
+
+def test_admin_revokes_every_session_of_a_user(client, admin, make_user):
+    user_id, headers = make_user("user")
+    _, other = make_user("other")
+    client.get("/api/currentUser", headers=headers)
+    response = client.post(f"/api/admin/users/{user_id}/sessions/revoke", headers=admin[1])
+    assert response.json() == {"revoked": 1}
+    assert client.get("/api/currentUser", headers=headers).status_code == 401
+    assert client.get("/api/currentUser", headers=other).status_code == 200
+    sessions = client.get(f"/api/admin/users/{user_id}/sessions", headers=admin[1]).json()
+    assert len(sessions) == 1 and sessions[0]["revoked_at"] is not None
+
+
+def test_deleted_user_is_logged_out(client, admin, make_user):
+    user_id, headers = make_user("user")
+    client.get("/api/currentUser", headers=headers)
+    assert client.delete(f"/api/admin/users/{user_id}", headers=admin[1]).status_code == 200
+    assert client.get("/api/currentUser", headers=headers).status_code == 401
+
+
+def test_revocation_by_another_worker_applies_at_refresh(client, make_user):
+    user_id, headers = make_user("user")
+    assert client.get("/api/currentUser", headers=headers).status_code == 200
+    # What another worker's revocation leaves behind: only the row
+    with main.engine.begin() as conn:
+        conn.execute(update(main.AuthSession).where(main.AuthSession.user_id == user_id)
+                     .values(revoked_at=datetime.utcnow()))
+    assert client.get("/api/currentUser", headers=headers).status_code == 200
+    client.portal.call(main.revoked_tokens.refresh)
+    assert client.get("/api/currentUser", headers=headers).status_code == 401
+
+
+def test_tokens_without_jti_after_cutover(client, make_user, monkeypatch):
+    make_user("user")
+    legacy = {"Authorization": "Bearer " + main.create_access_token(data={"sub": "user"})}
+    assert client.get("/api/currentUser", headers=legacy).status_code == 200
+    main.auth_cache.clear()
+    monkeypatch.setattr(main, "REQUIRE_TOKEN_JTI", True)
+    assert client.get("/api/currentUser", headers=legacy).status_code == 401
+    _, headers = make_user("other")
+    assert client.get("/api/currentUser", headers=headers).status_code == 200
+
+
+def test_expired_sessions_are_purged_in_the_background_only(client, make_user):
+    user_id, _ = make_user("user")
+    with main.engine.begin() as conn:
+        conn.execute(insert(main.AuthSession).values(
+            jti="expired", user_id=user_id, expires_at=datetime.utcnow() - timedelta(minutes=1)
+        ))
+    client.post("/api/login", json={"username": "user", "password": "user"})
+    assert session_count() == 3
+    assert client.portal.call(main.purge_expired_sessions) == 1
+    assert session_count() == 2
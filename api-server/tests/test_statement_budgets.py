@@ -0,0 +1,147 @@
+"""
+SQL statements per request, against per-endpoint budgets
+
+Each endpoint runs once against a seeded address book with warm auth
+caches. The seeded tables are larger than any budget, so a per-row query
+(an N+1) overshoots it. Lower a budget when an endpoint gets cheaper.
+"""
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event, insert
+
+import main
+
+PEERS = 40
+BULK = 30
+
+
+@contextmanager
+def count_statements():
+    """Collect the statements run on behalf of requests, background tasks are left out"""
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if main.request_stats.get() is not None:
+            statements.append(statement)
+
+    event.listen(main.async_engine.sync_engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(main.async_engine.sync_engine, "before_cursor_execute", count)
+
+
+@pytest.fixture
+def book(client, admin, make_user, seed_clients, grant):
+    """Peers with tags, a user with direct and group grants, and a second user to administer"""
+    user_id, user_headers = make_user("user")
+    other_id, _ = make_user("other")
+    client_ids = [f"{100000000 + i}" for i in range(PEERS)]
+    ids = seed_clients(client_ids, tags=("office", "linux"))
+    grant(user_id, ids[:PEERS // 2], "write")
+    with main.engine.begin() as conn:
+        user_group = conn.execute(insert(main.UserGroup).values(name="staff").returning(main.UserGroup.id)).scalar()
+        client_group = conn.execute(insert(main.ClientGroup).values(name="servers").returning(main.ClientGroup.id)).scalar()
+        conn.execute(insert(main.UserGroupMember), [{"group_id": user_group, "user_id": user_id}])
+        conn.execute(insert(main.ClientGroupMember), [
+            {"group_id": client_group, "client_id": id} for id in ids[PEERS // 2:]
+        ])
+        conn.execute(insert(main.GroupPermission).values(
+            user_group_id=user_group, client_group_id=client_group, permission_type="read"
+        ))
+        for stmt in main.effective_permission_statements([user_id]):
+            conn.execute(stmt)
+    headers = {"admin": admin[1], "user": user_headers}
+    for h in headers.values():
+        client.get("/api/currentUser", headers=h)  # warm the auth cache
+    return {
+        "headers": headers,
+        "client": client_ids[0],
+        "client_ids": client_ids,
+        "client_pk": ids[0],
+        "ids": ids,
+        "user_id": user_id,
+        "other_id": other_id,
+        "user_group": user_group,
+        "client_group": client_group,
+    }
+
+
+def new_peers(n: int, start: int = 0) -> list:
+    return [{"id": f"{200000000 + i}", "alias": f"new-{i}", "tags": ["new"]} for i in range(start, start + n)]
+
+
+# (name, caller, method, path, body, budget), paths and bodies are filled in from the book fixture
+CASES = [
+    # Reads
+    ("ab list", "user", "GET", "/api/ab/list", None, 1),
+    ("peers, admin", "admin", "POST", "/api/ab/peers?pageSize=100", None, 4),
+    ("peers", "user", "POST", "/api/ab/peers?pageSize=100", None, 4),
+    ("peers, cursor", "user", "POST", "/api/ab/peers?cursor=&pageSize=100", None, 3),
+    ("peers, tag", "user", "POST", "/api/ab/peers?tag=office&pageSize=100", None, 4),
+    ("peers, search", "admin", "POST", "/api/ab/peers?alias=host&pageSize=100", None, 5),
+    ("changes", "user", "GET", "/api/ab/changes?since=0", None, 4),
+    ("admin users", "admin", "GET", "/api/admin/users", None, 1),
+    ("admin clients", "admin", "GET", "/api/admin/clients", None, 2),
+    ("admin client permissions", "admin", "GET", "/api/admin/permissions/{client_pk}", None, 1),
+    ("admin user groups", "admin", "GET", "/api/admin/groups/users", None, 1),
+    ("admin client group", "admin", "GET", "/api/admin/groups/clients/{client_group}", None, 2),
+    ("admin group permissions", "admin", "GET", "/api/admin/group-permissions", None, 1),
+    ("admin user sessions", "admin", "GET", "/api/admin/users/{user_id}/sessions", None, 1),
+    ("admin export", "admin", "GET", "/api/admin/export", None, 2),
+    # Peer writes
+    ("add peer", "user", "POST", "/api/ab/peer/add/default", {"id": "300000000", "tags": ["a", "b"]}, 10),
+    ("add peer, existing", "user", "POST", "/api/ab/peer/add/default", {"id": "{client}", "alias": "x"}, 5),
+    ("update peer", "user", "PUT", "/api/ab/peer/update/default", {"id": "{client}", "tags": ["c"]}, 6),
+    ("delete peer", "admin", "DELETE", "/api/ab/peer/delete/default/{client}", None, 11),
+    ("delete peers", "admin", "DELETE", "/api/ab/peer/default", "{client_ids}", 11),
+    ("bulk add", "user", "POST", "/api/ab/peer/bulk/default", "{bulk}", 11),
+    ("bulk add, admin", "admin", "POST", "/api/ab/peer/bulk/default", "{bulk}", 11),
+    # Grants and groups
+    ("grant", "admin", "POST", "/api/admin/permissions/grant",
+     {"user_id": "{other_id}", "client_id": "{client_pk}", "permission_type": "write"}, 8),
+    ("bulk grant by tag", "admin", "POST", "/api/admin/permissions/bulk-grant",
+     {"user_id": "{other_id}", "tag": "office"}, 8),
+    ("bulk revoke", "admin", "POST", "/api/admin/permissions/bulk-revoke",
+     {"user_id": "{user_id}", "client_ids": "{ids}"}, 7),
+    ("create group", "admin", "POST", "/api/admin/groups/users", {"name": "ops"}, 2),
+    ("group members", "admin", "PUT", "/api/admin/groups/clients/{client_group}/members",
+     {"add": "{ids}", "remove": []}, 7),
+    ("delete group", "admin", "DELETE", "/api/admin/groups/clients/{client_group}", None, 10),
+    ("group grant", "admin", "POST", "/api/admin/group-permissions/grant",
+     {"user_group_id": "{user_group}", "client_group_id": "{client_group}", "permission_type": "write"}, 8),
+    ("group revoke", "admin", "POST", "/api/admin/group-permissions/revoke",
+     {"user_group_id": "{user_group}", "client_group_id": "{client_group}"}, 6),
+    # Users and sessions
+    ("login", None, "POST", "/api/login", {"username": "other", "password": "other"}, 2),
+    ("logout", "user", "POST", "/api/logout", None, 1),
+    ("create user", "admin", "POST", "/api/admin/users", {"username": "new", "password": "new"}, 3),
+    ("update user", "admin", "PUT", "/api/admin/users/{user_id}", {"role": "admin", "password": "changed"}, 4),
+    ("delete user", "admin", "DELETE", "/api/admin/users/{user_id}", None, 9),
+    ("revoke sessions", "admin", "POST", "/api/admin/users/{user_id}/sessions/revoke", None, 1),
+    ("stats", "admin", "GET", "/api/admin/stats", None, 0),
+]
+
+
+def fill(value, book: dict):
+    """Substitute "{name}" placeholders in a path or body with values from the book fixture"""
+    values = dict(book, bulk=new_peers(BULK) + [{"id": c, "note": "seen"} for c in book["client_ids"][:10]])
+    if isinstance(value, dict):
+        return {k: fill(v, book) for k, v in value.items()}
+    if isinstance(value, str) and value.startswith("{") and value.endswith("}") and value[1:-1] in values:
+        return values[value[1:-1]]
+    if isinstance(value, str):
+        return value.format(**values)
+    return value
+
+
+@pytest.mark.parametrize("name, who, method, path, body, budget", CASES, ids=[c[0] for c in CASES])
+def test_statement_budget(client, book, name, who, method, path, body, budget):
+    headers = book["headers"][who] if who else {}
+    with count_statements() as statements:
+        response = client.request(method, fill(path, book), json=fill(body, book), headers=headers)
+    assert response.status_code == 200, response.text
+    assert "error" not in response.text[:20], response.text
+    assert len(statements) <= budget, "\n".join(statements)
@@ -0,0 +1,77 @@
+"""
+Write queue: taken from a transaction's first write to its commit, across workers
+"""
+
+import subprocess
+import sys
+import time
+
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+import main
+
+
+def test_turn_is_given_back_after_each_write(client, admin):
+    completed = main.write_queue.stats()["completed"]
+    for i in range(3):
+        response = client.post("/api/ab/peer/add/default", json={"id": f"10000000{i}"}, headers=admin[1])
+        assert response.json() == {"message": "Success"}
+    stats = main.write_queue.stats()
+    assert stats["completed"] == completed + 3
+    assert not stats["writing"]
+
+
+def test_failed_write_gives_turn_back(client, admin):
+    async def duplicate_user():
+        async with main.AsyncSessionLocal() as db:
+            await db.execute(insert(main.User).values(username="admin", password_hash="!"))
+
+    with pytest.raises(IntegrityError):
+        client.portal.call(duplicate_user)
+    assert not main.write_queue.stats()["writing"]
+    assert client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1]).status_code == 200
+
+
+def test_passwords_are_hashed_outside_the_queue(client, admin, make_user, monkeypatch):
+    user_id, _ = make_user("user")
+    held = []
+    hash_password = main.get_password_hash
+
+    def get_password_hash(password):
+        held.append(main.write_queue.stats()["writing"])
+        return hash_password(password)
+
+    monkeypatch.setattr(main, "get_password_hash", get_password_hash)
+    client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1])
+    client.post("/api/ab/peer/add/default", json={"id": "100000000", "password": "x", "tags": ["a"]}, headers=admin[1])
+    client.put(f"/api/admin/users/{user_id}", json={"role": "admin", "password": "changed"}, headers=admin[1])
+    client.post("/api/admin/users", json={"username": "new", "password": "new"}, headers=admin[1])
+    assert held == [False, False, False]
+
+
+def test_other_process_holding_the_lock_makes_writers_wait(client, admin, monkeypatch):
+    lock_path = main.write_queue.lock_path
+    assert lock_path is not None
+    holder = subprocess.Popen([sys.executable, "-c", (
+        "import fcntl, sys, time\n"
+        f"f = open({lock_path!r}, 'a')\n"
+        "fcntl.flock(f, fcntl.LOCK_EX)\n"
+        "print('locked', flush=True)\n"
+        "time.sleep(30)\n"
+    )], stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline().strip() == "locked"
+        monkeypatch.setattr(main.write_queue, "timeout", 0.3)
+        start = time.perf_counter()
+        response = client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1])
+        assert response.status_code == 503
+        assert time.perf_counter() - start >= 0.3
+        # Reads never wait for the writer
+        assert client.post("/api/ab/peers", headers=admin[1]).status_code == 200
+    finally:
+        holder.kill()
+        holder.wait()
+    response = client.post("/api/ab/peer/add/default", json={"id": "100000000"}, headers=admin[1])
+    assert response.json() == {"message": "Success"}
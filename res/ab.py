@@ -2,6 +2,7 @@
 
 import requests
 import argparse
+import csv
 import json
 from datetime import datetime, timedelta
 
@@ -84,6 +85,8 @@ def view_ab_peers(url, token, ab_guid, peer_id=None, alias=None):
         if v is not None
     }
     filtered_params["pageSize"] = pageSize
+    # Ask for cursor paging; servers that don't support it ignore this
+    filtered_params["cursor"] = ""
 
     peers = []
     current = 0
@@ -104,6 +107,14 @@ def view_ab_peers(url, token, ab_guid, peer_id=None, alias=None):
         data = response_json.get("data", [])
         peers.extend(data)
 
+        if "next" in response_json:
+            # Cursor paging, follow the next token until the server runs out
+            if not response_json["next"]:
+                break
+            filtered_params["cursor"] = response_json["next"]
+            continue
+        filtered_params.pop("cursor", None)
+
         total = response_json.get("total", 0)
         if len(data) < pageSize or current * pageSize >= total:
             break
@@ -214,6 +225,77 @@ def update_peer(url, token, ab_guid, peer_id, alias=None, note=None, tags=None,
     return check_response(response)
 
 
+def parse_tags_cell(tags_str):
+    """Tags from a CSV cell, a JSON array as exported by the server or a comma-separated list"""
+    tags_str = tags_str.strip()
+    if tags_str.startswith('[') and tags_str.endswith(']'):
+        try:
+            tags = json.loads(tags_str)
+        except ValueError:
+            tags_str = tags_str[1:-1]
+        else:
+            if isinstance(tags, list):
+                return [str(tag) for tag in tags]
+    return [tag.strip() for tag in tags_str.split(",") if tag.strip()]
+
+
+def read_peers_file(path):
+    """Yield peers from a JSONL file, or a CSV file with id,alias,note,tags,password columns"""
+    with open(path, newline="") as f:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                peer = {k: v for k, v in row.items() if k and v not in (None, "")}
+                if "tags" in peer:
+                    peer["tags"] = parse_tags_cell(peer["tags"])
+                yield peer
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def bulk_add_peers(url, token, ab_guid, path, chunk_size=500):
+    """Add or update peers from a CSV/JSONL file, streamed to the server in chunks"""
+    headers = {"Authorization": f"Bearer {token}"}
+    summary = {"created": 0, "updated": 0, "failed": 0, "errors": []}
+
+    def send(chunk):
+        print(f"Sending {len(chunk)} peers to address book")
+        response = requests.post(f"{url}/api/ab/peer/bulk/{ab_guid}", headers=headers, json=chunk)
+        result = check_response(response)
+        for key in ["created", "updated", "failed"]:
+            summary[key] += result.get(key, 0)
+        summary["errors"].extend(r for r in result.get("data", []) if r.get("result") == "error")
+
+    chunk = []
+    for peer in read_peers_file(path):
+        chunk.append(peer)
+        if len(chunk) >= chunk_size:
+            send(chunk)
+            chunk = []
+    if chunk:
+        send(chunk)
+
+    return summary
+
+
+def export_peers(url, token, path, format=None):
+    """Stream every peer from the admin export endpoint straight to a file"""
+    headers = {"Authorization": f"Bearer {token}"}
+    if format is None:
+        format = "csv" if path.lower().endswith(".csv") else "ndjson"
+    with requests.get(f"{url}/api/admin/export", headers=headers, params={"format": format}, stream=True) as response:
+        if response.status_code != 200:
+            print(f"Error: HTTP {response.status_code} - {response.text}")
+            exit(1)
+        written = 0
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=65536):
+                f.write(chunk)
+                written += len(chunk)
+    print(f"Exported {written} bytes to {path}")
+
+
 def str2color(tag_name, existing_colors=None):
     """Generate color for tag name similar to str2color2 function"""
     if existing_colors is None:
@@ -510,8 +592,8 @@ def main():
     # Required arguments
     parser.add_argument(
         "command",
-        choices=["view-ab", "add-ab", "update-ab", "delete-ab", "get-personal-ab",
-                "view-peer", "add-peer", "update-peer", "delete-peer",
+        choices=["view-ab", "add-ab", "update-ab", "delete-ab", "get-personal-ab", "export",
+                "view-peer", "add-peer", "update-peer", "delete-peer", "bulk-add",
                 "view-tag", "add-tag", "update-tag", "delete-tag",
                 "view-rule", "add-rule", "update-rule", "delete-rule"],
         help="Command to execute",
@@ -535,6 +617,9 @@ def main():
     parser.add_argument("--peer-id", help="Peer ID")
     parser.add_argument("--alias", help="Peer alias")
     parser.add_argument("--tags", help="Peer tags (supports both 'tag1,tag2' and '[tag1,tag2]' formats, use '[]' to clear tags)")
+    parser.add_argument("--file", help="CSV (id,alias,note,tags,password) or JSONL file of peers (for bulk-add and export)")
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="Export format (for export, defaults from the --file extension)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Peers per request (for bulk-add)")
     
     # Tag management arguments
     parser.add_argument("--tag-name", help="Tag name")
@@ -563,6 +648,14 @@ def main():
         personal_ab = get_personal_ab(args.url, args.token)
         print(json.dumps(personal_ab, indent=2))
     
+    elif args.command == "export":
+        # Export every peer (admin only)
+        if not args.file:
+            print("Error: --file is required for export command")
+            return
+        
+        export_peers(args.url, args.token, args.file, args.format)
+    
     elif args.command in ["add-ab", "update-ab", "delete-ab"]:
         # Address book management commands
         if args.command == "add-ab":
@@ -603,7 +696,7 @@ def main():
                 result = delete_shared_abs(args.url, args.token, ab_guid)
                 print(f"Result: {result}")
     
-    elif args.command in ["view-peer", "add-peer", "update-peer", "delete-peer", "view-tag", "add-tag", "update-tag", "delete-tag", "view-rule", "add-rule", "update-rule", "delete-rule"]:
+    elif args.command in ["view-peer", "add-peer", "update-peer", "delete-peer", "bulk-add", "view-tag", "add-tag", "update-tag", "delete-tag", "view-rule", "add-rule", "update-rule", "delete-rule"]:
         if not args.ab_name and not args.ab_guid:
             print("Error: --ab-name or --ab-guid is required for this command")
             return
@@ -695,6 +788,14 @@ def main():
             result = delete_peer(args.url, args.token, ab_guid, args.peer_id)
             print(f"Result: {result}")
         
+        elif args.command == "bulk-add":
+            if not args.file:
+                print("Error: --file is required for bulk-add command")
+                return
+            
+            result = bulk_add_peers(args.url, args.token, ab_guid, args.file, args.chunk_size)
+            print(json.dumps(result, indent=2))
+        
         elif args.command == "view-tag":
             tags = view_ab_tags(args.url, args.token, ab_guid)
             print(json.dumps(tags, indent=2))